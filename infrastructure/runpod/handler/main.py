@@ -4,24 +4,27 @@ RunPod Transcoding Handler
 GPU-accelerated media transcoding pipeline for video and audio files.
 
 Pipeline:
-1. Download original from R2
+1. Download original from R2 (or stream video via presigned URL)
 2. Probe metadata (ffprobe)
-3. Create mezzanine (CRF 18) → Upload to B2
-4. Two-pass loudness analysis
-5. Transcode HLS variants (1080p/720p/480p/360p + source fallback)
-6. Generate preview (30s at 720p)
+3. Mezzanine (CRF 18, gated) → Upload to B2; encoded in step 5's pass
+4. Loudness analysis (first pass of two-pass loudnorm)
+5. Transcode HLS variants in one ffmpeg pass (720p/480p + source fallback)
+6. Generate preview (30s cut from the 720p rung, encoded if there is none)
 7. Extract thumbnail (10% mark)
-8. Generate waveform JSON + PNG (audio only)
-9. Upload outputs to R2
+8. Generate waveform JSON + PNG from one decode (audio only)
+9. Upload outputs to R2 (parallel, tuned multipart transfers; HLS uploads
+   while thumbnails/waveform are generated)
 10. Send signed webhook (with retry)
 
 FFmpeg Settings:
-- GPU: h264_nvenc, preset p4, cq 23
+- GPU: h264_nvenc, preset p7 (tune hq, VBR, full-res multipass), cq 23
 - CPU fallback: libx264, preset fast, crf 23
 - HLS: 6s segments, VOD playlist type
-- Audio: loudnorm I=-16 TP=-1.5 LRA=11
+- Audio: loudnorm I=-16 TP=-1.5 LRA=11 (linear second pass when measured)
 """
 
+import atexit
+import functools
 import hashlib
 import hmac
 import json
@@ -31,13 +34,17 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
-from typing import Any, TypedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, TypedDict
 from urllib.parse import urlparse
 
 import boto3
 import requests
 import runpod
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # =============================================================================
 # Feature Flags
@@ -61,6 +68,10 @@ FEATURES = {
     "waveform_image": _env_flag("ENABLE_WAVEFORM_IMAGE", default=True),
     "thumbnail_variants": _env_flag("ENABLE_THUMBNAIL_VARIANTS", default=True),
     "video_preview": _env_flag("ENABLE_VIDEO_PREVIEW", default=True),
+    # Read video sources straight from a presigned R2 URL instead of staging
+    # them on local disk. Off by default: the pipeline reads the source more
+    # than once (loudness, HLS, thumbnails), and each pass re-fetches it.
+    "stream_input": _env_flag("ENABLE_STREAM_INPUT", default=False),
 }
 
 
@@ -133,51 +144,195 @@ PREVIEW_HEIGHT = 720
 # Segment duration for HLS
 HLS_SEGMENT_DURATION = 6
 
+# Per-attempt ffmpeg timeouts (seconds): full-length encodes, preview clip,
+# ffprobe, loudness analysis pass, thumbnail grab
+ENCODE_TIMEOUT = 3600
+PREVIEW_TIMEOUT = 120
+PROBE_TIMEOUT = 30
+LOUDNESS_TIMEOUT = 300
+THUMBNAIL_TIMEOUT = 60
+
+# Presigned input URLs must outlive every read of the source: probe, loudness,
+# up to three attempts (see _run_encode) of the full-length pass (which may
+# carry the mezzanine, doubling its budget) and of the preview encode, and the
+# thumbnail grab, plus a margin for uploads in between.
+STREAM_URL_EXPIRY = (
+    PROBE_TIMEOUT
+    + LOUDNESS_TIMEOUT
+    + 3 * (2 * ENCODE_TIMEOUT + PREVIEW_TIMEOUT)
+    + THUMBNAIL_TIMEOUT
+    + 600
+)
+
+# Waveform resolution: JSON points per second, PNG width in pixels
+WAVEFORM_PIXELS_PER_SECOND = 10
+WAVEFORM_IMAGE_WIDTH = 1800
+
+# EBU R128 loudness target (integrated / true peak / range)
+LOUDNORM_TARGET = "I=-16:TP=-1.5:LRA=11"
+
+# loudnorm's print_format=json summary block, as it appears in ffmpeg's stderr
+_LOUDNORM_JSON_RE = re.compile(rb'\{[^{}]*"input_i"[^{}]*\}')
+
 
 # =============================================================================
 # FFmpeg Helper
 # =============================================================================
 
 
+# Prepended to every ffmpeg invocation: only errors reach stderr, so a long
+# encode's progress/banner output is never buffered in memory.
+_FFMPEG_QUIET_ARGS = ("-hide_banner", "-nostats", "-loglevel", "error")
+
+# Query string of any http(s) URL; presigned URLs carry X-Amz-Credential and
+# X-Amz-Signature there
+_URL_QUERY_RE = re.compile(r"(https?://[^\s?#'\"]+)\?[^\s'\"]*")
+
+
+def _redact_urls(text: str) -> str:
+    """Strip URL query strings from text headed for errors, webhooks or logs."""
+    return _URL_QUERY_RE.sub(r"\1?<redacted>", text)
+
+
 def run_ffmpeg(
-    cmd: list[str], timeout: int = 3600, description: str = "ffmpeg"
+    cmd: list[str],
+    timeout: int = 3600,
+    description: str = "ffmpeg",
+    capture_stdout: bool = False,
 ) -> subprocess.CompletedProcess:
     """Run an ffmpeg/ffprobe command with proper error capture.
 
-    On failure, raises RuntimeError with the last 2KB of stderr
-    so the actual ffmpeg error message is preserved for debugging.
+    stdout is discarded unless capture_stdout is set (ffprobe's JSON). On
+    failure, raises RuntimeError with the last 2KB of stderr so the actual
+    ffmpeg error message is preserved for debugging.
     """
+    if cmd[0] == "ffmpeg":
+        cmd = [cmd[0], *_FFMPEG_QUIET_ARGS, *cmd[1:]]
     try:
         return subprocess.run(
-            cmd, check=True, capture_output=True, text=True, timeout=timeout
+            cmd,
+            check=True,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=timeout,
         )
     except subprocess.CalledProcessError as e:
-        stderr_excerpt = (e.stderr or "")[-2000:]
+        # ffmpeg echoes its input URL in errors; a streamed source is presigned
+        stderr_excerpt = _redact_urls(e.stderr or "")[-2000:]
         raise RuntimeError(
             f"{description} failed (exit {e.returncode}): {stderr_excerpt}"
         ) from e
 
 
+def _input_args(input_path: str) -> list[str]:
+    """Input arguments for ffmpeg/ffprobe.
+
+    Remote (presigned) sources get reconnect options so a dropped connection
+    mid-read resumes instead of failing a long encode.
+    """
+    if input_path.startswith(("http://", "https://")):
+        return [
+            "-reconnect",
+            "1",
+            "-reconnect_streamed",
+            "1",
+            "-reconnect_delay_max",
+            "5",
+            "-i",
+            input_path,
+        ]
+    return ["-i", input_path]
+
+
 # =============================================================================
 # Storage Clients
 # =============================================================================
 
+# boto3 defaults (8 MiB parts, 10 threads) leave multi-GB sources and outputs
+# latency-bound; larger parts with more in flight keep the link saturated.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=32,
+    use_threads=True,
+)
+
+# Files uploaded concurrently by upload_directory / upload_directory_tracked
+UPLOAD_WORKERS = 16
+
+# Every upload worker can have max_concurrency part requests in flight on the
+# shared client, plus one more single-file transfer (thumbnails, mezzanine)
+# while the HLS directory uploads in the background. botocore's default pool
+# of 10 would discard connections instead of keeping them alive. Connections
+# are opened on demand, so an idle pool this size costs nothing.
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=(UPLOAD_WORKERS + 1) * TRANSFER_CONFIG.max_concurrency,
+)
+
+# Content-Type by file extension for directory uploads
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/MP2T",
+    ".json": "application/json",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+# Root for per-job scratch space (None = system temp dir). Only point this at
+# a tmpfs such as /dev/shm when it is sized for the largest source plus outputs.
+WORK_DIR_ROOT = os.environ.get("TRANSCODE_WORK_DIR") or None
+
+
+# Clients for this worker, keyed on endpoint and a credential fingerprint so
+# the secrets themselves never become long-lived cache keys.
+_S3_CLIENTS: dict[tuple[str, str], Any] = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+_S3_CLIENTS_MAX = 8
+
+
+def _credential_fingerprint(access_key: str, secret_key: str) -> str:
+    """SHA-256 digest identifying a key pair without retaining it."""
+    return hashlib.sha256(f"{access_key}\0{secret_key}".encode()).hexdigest()
+
 
 def create_s3_client(endpoint: str, access_key: str, secret_key: str) -> Any:
-    """Create S3-compatible client for R2 or B2."""
-    return boto3.client(
-        "s3",
-        endpoint_url=endpoint,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        region_name="auto",
-    )
+    """Create S3-compatible client for R2 or B2.
+
+    Cached per credentials: warm workers reuse the client (and its pooled TLS
+    connections) across jobs, and the R2 and assets clients share one.
+    """
+    cache_key = (endpoint, _credential_fingerprint(access_key, secret_key))
+    with _S3_CLIENTS_LOCK:
+        client = _S3_CLIENTS.get(cache_key)
+        if client is None:
+            if len(_S3_CLIENTS) >= _S3_CLIENTS_MAX:
+                del _S3_CLIENTS[next(iter(_S3_CLIENTS))]
+            client = _S3_CLIENTS[cache_key] = boto3.client(
+                "s3",
+                endpoint_url=endpoint,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                region_name="auto",
+                config=S3_CLIENT_CONFIG,
+            )
+    return client
 
 
 def download_file(client: Any, bucket: str, key: str, local_path: str) -> None:
     """Download file from S3-compatible storage."""
     print(f"Downloading s3://{bucket}/{key} → {local_path}")
-    client.download_file(bucket, key, local_path)
+    client.download_file(bucket, key, local_path, Config=TRANSFER_CONFIG)
+
+
+def presign_input_url(
+    client: Any, bucket: str, key: str, expires_in: int = STREAM_URL_EXPIRY
+) -> str:
+    """Presigned GET URL that ffmpeg/ffprobe can read the object from directly."""
+    return client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expires_in
+    )
 
 
 def upload_file(
@@ -185,63 +340,77 @@ def upload_file(
 ) -> None:
     """Upload file to S3-compatible storage."""
     print(f"Uploading {local_path} → s3://{bucket}/{key}")
-    extra_args = {}
-    if content_type:
-        extra_args["ContentType"] = content_type
     client.upload_file(
-        local_path, bucket, key, ExtraArgs=extra_args if extra_args else None
+        local_path,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type} if content_type else None,
+        Config=TRANSFER_CONFIG,
     )
 
 
+def _list_upload_files(
+    key_prefix: str, local_dir: str
+) -> list[tuple[str, str, str | None]]:
+    """Collect (local_path, key, content_type) for every file under local_dir."""
+    files: list[tuple[str, str, str | None]] = []
+    # scandir entries carry their file type, so no extra stat per entry
+    pending = [(local_dir, "")]
+    while pending:
+        directory, relative_dir = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}{entry.name}"
+                if entry.is_dir():
+                    pending.append((entry.path, f"{relative_path}/"))
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                files.append(
+                    (entry.path, f"{key_prefix}{relative_path}", CONTENT_TYPES.get(ext))
+                )
+    return files
+
+
 def upload_directory(client: Any, bucket: str, key_prefix: str, local_dir: str) -> None:
-    """Upload all files in a directory to S3-compatible storage."""
-    for root, _, files in os.walk(local_dir):
-        for filename in files:
-            local_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(local_path, local_dir)
-            key = f"{key_prefix}{relative_path}"
-
-            # Determine content type
-            content_type = None
-            if filename.endswith(".m3u8"):
-                content_type = "application/vnd.apple.mpegurl"
-            elif filename.endswith(".ts"):
-                content_type = "video/MP2T"
-            elif filename.endswith(".json"):
-                content_type = "application/json"
-            elif filename.endswith(".png"):
-                content_type = "image/png"
-            elif filename.endswith(".jpg") or filename.endswith(".jpeg"):
-                content_type = "image/jpeg"
-
-            upload_file(client, bucket, key, local_path, content_type)
+    """Upload all files in a directory to S3-compatible storage (in parallel)."""
+    files = _list_upload_files(key_prefix, local_dir)
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = [
+            pool.submit(upload_file, client, bucket, key, local_path, content_type)
+            for local_path, key, content_type in files
+        ]
+    for future in futures:
+        future.result()
 
 
 def upload_directory_tracked(
     client: Any, bucket: str, key_prefix: str, local_dir: str
 ) -> list[tuple[Any, str, str]]:
-    """Upload all files in a directory and return list of (client, bucket, key) for cleanup."""
+    """Upload all files in a directory and return list of (client, bucket, key) for cleanup.
+
+    Files upload in parallel. If any upload fails, the ones that succeeded are
+    deleted before the first error is re-raised — the caller never sees their
+    keys, so it could not clean them up itself.
+    """
+    files = _list_upload_files(key_prefix, local_dir)
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = [
+            (key, pool.submit(upload_file, client, bucket, key, local_path, ctype))
+            for local_path, key, ctype in files
+        ]
+
     uploaded: list[tuple[Any, str, str]] = []
-    for root, _, files in os.walk(local_dir):
-        for filename in files:
-            local_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(local_path, local_dir)
-            key = f"{key_prefix}{relative_path}"
-
-            content_type = None
-            if filename.endswith(".m3u8"):
-                content_type = "application/vnd.apple.mpegurl"
-            elif filename.endswith(".ts"):
-                content_type = "video/MP2T"
-            elif filename.endswith(".json"):
-                content_type = "application/json"
-            elif filename.endswith(".png"):
-                content_type = "image/png"
-            elif filename.endswith(".jpg") or filename.endswith(".jpeg"):
-                content_type = "image/jpeg"
-
-            upload_file(client, bucket, key, local_path, content_type)
+    errors: list[BaseException] = []
+    for key, future in futures:
+        error = future.exception()
+        if error is None:
             uploaded.append((client, bucket, key))
+        else:
+            errors.append(error)
+
+    if errors:
+        cleanup_uploaded_keys(uploaded)
+        raise errors[0]
     return uploaded
 
 
@@ -364,10 +533,19 @@ def probe_media(input_path: str) -> dict[str, Any]:
         "json",
         "-show_format",
         "-show_streams",
-        input_path,
+        *_input_args(input_path),
     ]
-    result = run_ffmpeg(cmd, timeout=30, description="ffprobe")
-    return json.loads(result.stdout)
+    # Surface timeouts and truncated output as RuntimeError like other ffprobe
+    # failures, so a streamed input still falls back to downloading.
+    try:
+        result = run_ffmpeg(
+            cmd, timeout=PROBE_TIMEOUT, description="ffprobe", capture_stdout=True
+        )
+        return json.loads(result.stdout)
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"ffprobe timed out after {e.timeout}s") from e
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"ffprobe returned invalid JSON: {e}") from e
 
 
 def get_media_info(probe_data: dict[str, Any]) -> tuple[int, int | None, int | None]:
@@ -385,6 +563,23 @@ def get_media_info(probe_data: dict[str, Any]) -> tuple[int, int | None, int | N
     return duration, width, height
 
 
+def get_frame_rate(probe_data: dict[str, Any]) -> float | None:
+    """Frame rate of the first video stream, or None if it can't be read.
+
+    ffprobe reports `r_frame_rate` as a fraction string such as "30000/1001".
+    """
+    for stream in probe_data.get("streams", []):
+        if stream.get("codec_type") != "video":
+            continue
+        num, _, den = str(stream.get("r_frame_rate", "")).partition("/")
+        try:
+            fps = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            return None
+        return fps if 0 < fps <= 240 else None
+    return None
+
+
 def validate_streams(probe_data: dict[str, Any], media_type: str) -> None:
     """Verify the file actually contains the expected stream types."""
     streams = probe_data.get("streams", [])
@@ -397,8 +592,13 @@ def validate_streams(probe_data: dict[str, Any], media_type: str) -> None:
         raise ValueError("File declared as audio but contains no audio streams")
 
 
+@functools.lru_cache(maxsize=1)
 def check_gpu_available() -> bool:
-    """Check if NVIDIA GPU encoder is actually usable (not just listed)."""
+    """Check if NVIDIA GPU encoder is actually usable (not just listed).
+
+    Cached: the worker process stays warm across jobs and its GPU does not
+    change, so the probe encode only runs on the first job.
+    """
     try:
         result = subprocess.run(
             [
@@ -423,74 +623,209 @@ def check_gpu_available() -> bool:
         return False
 
 
+@functools.lru_cache(maxsize=1)
+def gpu_scaling_available() -> bool:
+    """Check if this ffmpeg build has the `scale_npp` CUDA filter.
+
+    It needs a `--enable-libnpp` (nonfree) build; distro packages such as the
+    image's Ubuntu ffmpeg don't have it. Without it, GPU encodes decode with
+    NVDEC into host memory and scale on the CPU. Cached like the GPU check.
+    """
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-filters"],
+            capture_output=True,
+            text=True,
+            timeout=10,
+        )
+    except Exception:
+        return False
+    # Filter rows read " T.. name  V->V  description"
+    available = any(
+        line.split()[1:2] == ["scale_npp"] for line in result.stdout.splitlines()
+    )
+    print(f"scale_npp {'available' if available else 'unavailable'} in ffmpeg")
+    return available
+
+
 # =============================================================================
 # Transcoding Functions
 # =============================================================================
 
 
-def _build_mezzanine_cmd(input_path: str, output_path: str, use_gpu: bool) -> list[str]:
-    """Build ffmpeg command for mezzanine creation."""
+# Fixed argv fragments shared by the ffmpeg command builders. Built once at
+# import; builders splice them in and only format the per-job fields.
+# NVDEC decode. Frames come back to host memory, and codecs/pixel formats
+# NVDEC can't handle (4:2:2, 10-bit H.264, ProRes) are decoded in software.
+_NVDEC_ARGS = ("-hwaccel", "cuda")
+# NVDEC decode keeping frames in device memory for `scale_npp`; only for
+# sources NVDEC can decode and ffmpeg builds that have the filter.
+_CUDA_DECODE_ARGS = (*_NVDEC_ARGS, "-hwaccel_output_format", "cuda")
+
+# h264_nvenc settings for offline VoD encodes: slowest/highest-quality preset
+# with full-res multipass, B-frames as references and adaptive quantization.
+# Better quality at the same bitrate, still faster than realtime, since NVENC
+# is not the bottleneck here. The constant-quality level is set per use.
+_NVENC_ARGS = (
+    "-c:v",
+    "h264_nvenc",
+    "-preset",
+    "p7",
+    "-tune",
+    "hq",
+    "-rc",
+    "vbr",
+    "-multipass",
+    "fullres",
+    "-bf",
+    "3",
+    "-b_ref_mode",
+    "middle",
+    "-spatial_aq",
+    "1",
+    "-temporal_aq",
+    "1",
+)
+
+# libx264 fallbacks: archival mezzanine vs. delivery (HLS rungs, preview)
+_X264_MEZZANINE_ARGS = ("-c:v", "libx264", "-preset", "slow", "-crf", "18")
+_X264_DELIVERY_ARGS = ("-c:v", "libx264", "-preset", "fast", "-crf", "23")
+
+# Single-file VoD HLS muxer; followed by the segment file and playlist paths
+_HLS_MUXER_ARGS = (
+    "-f",
+    "hls",
+    "-hls_time",
+    str(HLS_SEGMENT_DURATION),
+    "-hls_playlist_type",
+    "vod",
+    "-hls_flags",
+    "single_file",
+    "-hls_segment_filename",
+)
+
+
+def _nvenc_args(cq: int) -> list[str]:
+    """h264_nvenc VoD settings (see _NVENC_ARGS) at constant quality `cq`."""
+    return [*_NVENC_ARGS, "-cq", str(cq)]
+
+
+def _decode_args(use_gpu: bool, device_frames: bool) -> tuple[str, ...]:
+    """Input-side hwaccel arguments for a CPU, NVDEC or CUDA-frames encode."""
+    if not use_gpu:
+        return ()
+    return _CUDA_DECODE_ARGS if device_frames else _NVDEC_ARGS
+
+
+def _run_encode(
+    build: Callable[[bool, bool], list[str]],
+    use_gpu: bool,
+    timeout: int,
+    description: str,
+) -> None:
+    """Run an encode, falling back from GPU to CPU.
+
+    `build(use_gpu, device_frames)` returns the ffmpeg command. On GPU the
+    all-device path (CUDA frames + scale_npp) is tried first when ffmpeg has
+    the filter; if that fails (e.g. a source NVDEC can't output as CUDA
+    frames), NVENC with host-side decode/scaling; then libx264 (e.g. OOM).
+    """
     if use_gpu:
-        return [
-            "ffmpeg",
-            "-y",
-            "-hwaccel",
-            "cuda",
-            "-i",
-            input_path,
-            "-c:v",
-            "h264_nvenc",
-            "-preset",
-            "p4",
-            "-cq",
-            "18",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "256k",
-            output_path,
-        ]
+        attempts = [(False, "GPU")]
+        if gpu_scaling_available():
+            attempts.insert(0, (True, "GPU, CUDA frames"))
+        for device_frames, label in attempts:
+            try:
+                run_ffmpeg(
+                    build(True, device_frames),
+                    timeout=timeout,
+                    description=f"{description} ({label})",
+                )
+                return
+            except RuntimeError as e:
+                print(f"{description} failed on {label}, falling back: {e}")
+
+    run_ffmpeg(build(False, False), timeout=timeout, description=f"{description} (CPU)")
+
+
+def _keyframe_args(fps: float | None, interval: int) -> list[str]:
+    """Closed, fixed-length GOPs with a keyframe every `interval` seconds.
+
+    Scene-cut keyframes are disabled so every GOP is the same length; the
+    time-based forced keyframes still land on the boundaries when the frame
+    rate is unknown.
+    """
+    args = []
+    if fps:
+        gop = str(max(1, round(fps * interval)))
+        args += ["-g", gop, "-keyint_min", gop]
+    return args + [
+        "-sc_threshold",
+        "0",
+        "-force_key_frames",
+        f"expr:gte(t,n_forced*{interval})",
+    ]
+
+
+def _mezzanine_output_args(
+    video_label: str, output_path: str, use_gpu: bool, fps: float | None
+) -> list[str]:
+    """Build the mezzanine output block (map + encoders + MP4 muxer).
+
+    Keyframes every 2s keep the archive seekable, and `+faststart` moves the
+    moov atom to the front so consumers can start reading before the end.
+    """
+    video_args = _nvenc_args(cq=18) if use_gpu else _X264_MEZZANINE_ARGS
     return [
-        "ffmpeg",
-        "-y",
-        "-i",
-        input_path,
-        "-c:v",
-        "libx264",
-        "-preset",
-        "slow",
-        "-crf",
-        "18",
+        "-map",
+        video_label,
+        "-map",
+        "0:a?",
+        *video_args,
+        *_keyframe_args(fps, 2),
         "-c:a",
         "aac",
         "-b:a",
         "256k",
+        "-movflags",
+        "+faststart",
         output_path,
     ]
 
 
-def create_mezzanine(input_path: str, output_path: str, use_gpu: bool) -> None:
+def _build_mezzanine_cmd(
+    input_path: str,
+    output_path: str,
+    use_gpu: bool,
+    fps: float | None = None,
+    device_frames: bool = False,
+) -> list[str]:
+    """Build ffmpeg command for standalone mezzanine creation."""
+    return [
+        "ffmpeg",
+        "-y",
+        *_decode_args(use_gpu, device_frames),
+        *_input_args(input_path),
+        *_mezzanine_output_args("0:v:0", output_path, use_gpu, fps),
+    ]
+
+
+def create_mezzanine(
+    input_path: str, output_path: str, use_gpu: bool, fps: float | None = None
+) -> None:
     """Create high-quality mezzanine file (CRF 18 for archival).
 
-    Falls back to CPU if GPU encoding fails (e.g. OOM).
+    Falls back to CPU if GPU encoding fails (see `_run_encode`).
     """
     print("Creating mezzanine (CRF 18)...")
 
-    if use_gpu:
-        try:
-            run_ffmpeg(
-                _build_mezzanine_cmd(input_path, output_path, use_gpu=True),
-                timeout=3600,
-                description="mezzanine (GPU)",
-            )
-            return
-        except RuntimeError as e:
-            print(f"GPU mezzanine failed, falling back to CPU: {e}")
-
-    run_ffmpeg(
-        _build_mezzanine_cmd(input_path, output_path, use_gpu=False),
-        timeout=3600,
-        description="mezzanine (CPU)",
+    _run_encode(
+        lambda gpu, device_frames: _build_mezzanine_cmd(
+            input_path, output_path, gpu, fps, device_frames
+        ),
+        use_gpu,
+        timeout=ENCODE_TIMEOUT,
+        description="mezzanine",
     )
 
 
@@ -505,28 +840,40 @@ def _safe_loudness(value: float, default: float) -> float:
 
 
 def analyze_loudness(input_path: str) -> dict[str, float]:
-    """Two-pass loudness analysis using loudnorm filter."""
+    """First pass of two-pass loudness normalization (measure only).
+
+    On success the result also carries `input_thresh` and `target_offset`, which
+    `_loudnorm_filter` feeds back into the HLS encodes as the second pass. The
+    fallback defaults omit them so the encoders stay on one-pass loudnorm
+    rather than normalizing against made-up measurements.
+    """
     print("Analyzing audio loudness...")
 
     cmd = [
         "ffmpeg",
-        "-i",
-        input_path,
+        "-hide_banner",
+        "-nostats",
+        *_input_args(input_path),
         "-af",
-        "loudnorm=I=-16:TP=-1.5:LRA=11:print_format=json",
+        f"loudnorm={LOUDNORM_TARGET}:print_format=json",
         "-f",
         "null",
         "-",
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+    # loudnorm prints its summary at info level, so this pass can't use
+    # run_ffmpeg's error-only logging; -nostats keeps stderr a few KB long.
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=LOUDNESS_TIMEOUT,
+    )
 
     # Parse loudnorm output from stderr
-    output = result.stderr
+    match = _LOUDNORM_JSON_RE.search(result.stderr)
     try:
-        json_start = output.rfind("{")
-        json_end = output.rfind("}") + 1
-        if json_start >= 0 and json_end > json_start:
-            loudness_data = json.loads(output[json_start:json_end])
+        if match:
+            loudness_data = json.loads(match.group(0))
             return {
                 "input_i": _safe_loudness(
                     float(loudness_data.get("input_i", -16)), -70.0
@@ -537,6 +884,12 @@ def analyze_loudness(input_path: str) -> dict[str, float]:
                 "input_lra": _safe_loudness(
                     float(loudness_data.get("input_lra", 7)), 0.0
                 ),
+                "input_thresh": _safe_loudness(
+                    float(loudness_data.get("input_thresh", -70)), -70.0
+                ),
+                "target_offset": _safe_loudness(
+                    float(loudness_data.get("target_offset", 0)), 0.0
+                ),
             }
     except (json.JSONDecodeError, ValueError):
         print("WARNING: Failed to parse loudness data, using defaults")
@@ -544,14 +897,47 @@ def analyze_loudness(input_path: str) -> dict[str, float]:
     return {"input_i": -16, "input_tp": -1, "input_lra": 7}
 
 
-def _build_hls_variant_cmd(
-    input_path: str,
+def _loudnorm_filter(loudness: dict[str, float] | None) -> str:
+    """Build the loudnorm audio filter for an encode.
+
+    With first-pass measurements this is the second (linear) pass, which
+    normalizes without loudnorm re-measuring the stream on the fly. Without
+    them it falls back to dynamic one-pass normalization.
+    """
+    if not loudness or "input_thresh" not in loudness:
+        return f"loudnorm={LOUDNORM_TARGET}"
+    return (
+        f"loudnorm={LOUDNORM_TARGET}"
+        f":measured_I={loudness['input_i']}"
+        f":measured_TP={loudness['input_tp']}"
+        f":measured_LRA={loudness['input_lra']}"
+        f":measured_thresh={loudness['input_thresh']}"
+        f":offset={loudness['target_offset']}"
+        ":linear=true"
+    )
+
+
+def _scale_filter(height: int, device_frames: bool) -> str:
+    """Scale filter for a target height.
+
+    With CUDA frames (`_CUDA_DECODE_ARGS`), `scale_npp` keeps them in device
+    memory through decode → scale → nvenc instead of round-tripping to the host.
+    """
+    if device_frames:
+        return f"scale_npp=-2:{height}:format=yuv420p"
+    return f"scale=-2:{height}"
+
+
+def _hls_output_args(
+    video_label: str,
     variant_dir: str,
     playlist_path: str,
     settings: dict,
     use_gpu: bool,
+    audio_filter: str,
+    keyframe_args: list[str],
 ) -> list[str]:
-    """Build ffmpeg command for a single HLS variant.
+    """Build the per-rung output block (map + encoders + HLS muxer).
 
     Uses `-hls_flags single_file`: all segments are stored in ONE MPEG-TS file
     (`stream.ts`) addressed by #EXT-X-BYTERANGE in the playlist. The streaming
@@ -560,59 +946,15 @@ def _build_hls_variant_cmd(
     """
     segment_path = os.path.join(variant_dir, "stream.ts")
 
-    if use_gpu:
-        return [
-            "ffmpeg",
-            "-y",
-            "-hwaccel",
-            "cuda",
-            "-i",
-            input_path,
-            "-vf",
-            f"scale=-2:{settings['height']}",
-            "-c:v",
-            "h264_nvenc",
-            "-preset",
-            "p4",
-            "-cq",
-            "23",
-            "-b:v",
-            settings["video_bitrate"],
-            "-maxrate",
-            settings["video_bitrate"],
-            "-bufsize",
-            f"{int(settings['video_bitrate'][:-1]) * 2}k",
-            "-c:a",
-            "aac",
-            "-b:a",
-            settings["audio_bitrate"],
-            "-af",
-            "loudnorm=I=-16:TP=-1.5:LRA=11",
-            "-f",
-            "hls",
-            "-hls_time",
-            str(HLS_SEGMENT_DURATION),
-            "-hls_playlist_type",
-            "vod",
-            "-hls_flags",
-            "single_file",
-            "-hls_segment_filename",
-            segment_path,
-            playlist_path,
-        ]
+    video_args = _nvenc_args(cq=23) if use_gpu else _X264_DELIVERY_ARGS
+
     return [
-        "ffmpeg",
-        "-y",
-        "-i",
-        input_path,
-        "-vf",
-        f"scale=-2:{settings['height']}",
-        "-c:v",
-        "libx264",
-        "-preset",
-        "fast",
-        "-crf",
-        "23",
+        "-map",
+        video_label,
+        "-map",
+        "0:a?",
+        *video_args,
+        *keyframe_args,
         "-b:v",
         settings["video_bitrate"],
         "-maxrate",
@@ -624,49 +966,118 @@ def _build_hls_variant_cmd(
         "-b:a",
         settings["audio_bitrate"],
         "-af",
-        "loudnorm=I=-16:TP=-1.5:LRA=11",
-        "-f",
-        "hls",
-        "-hls_time",
-        str(HLS_SEGMENT_DURATION),
-        "-hls_playlist_type",
-        "vod",
-        "-hls_flags",
-        "single_file",
-        "-hls_segment_filename",
+        audio_filter,
+        *_HLS_MUXER_ARGS,
         segment_path,
         playlist_path,
     ]
 
 
-def _encode_hls_variant(
+def _build_hls_ladder_cmd(
     input_path: str,
-    variant_dir: str,
-    playlist_path: str,
-    settings: dict,
-    variant_name: str,
+    output_dir: str,
+    variants: list[tuple[str, dict]],
     use_gpu: bool,
+    loudness: dict[str, float] | None = None,
+    fps: float | None = None,
+    mezzanine_path: str | None = None,
+    device_frames: bool = False,
+) -> list[str]:
+    """Build ONE ffmpeg command that emits every HLS variant.
+
+    The source is decoded once and the rungs are scaled as a cascade: the
+    largest rung scales from the source, and each smaller rung scales from the
+    one above it (720p → 480p rather than 4K → 480p), with `split` handing a
+    copy of every intermediate to its own encoder + HLS muxer block.
+
+    Every rung gets the same keyframe cadence, one per segment, so segment
+    boundaries line up across rungs for clean ABR switching.
+
+    With `mezzanine_path`, the decoded source is also split off unscaled to
+    the mezzanine encoder, so the archive copy costs no second decode.
+    """
+    labels = [f"[v{i}]" for i in range(len(variants))]
+    by_height = sorted(
+        range(len(variants)), key=lambda i: variants[i][1]["height"], reverse=True
+    )
+    filters = []
+    source = "[0:v]"
+    if mezzanine_path:
+        filters.append("[0:v]split=2[mz][src]")
+        source = "[src]"
+    for position, i in enumerate(by_height):
+        height = variants[i][1]["height"]
+        scaled = f"{source}{_scale_filter(height, device_frames)}"
+        if position == len(by_height) - 1:
+            filters.append(f"{scaled}{labels[i]}")
+        else:
+            filters.append(f"{scaled},split=2{labels[i]}[c{i}]")
+            source = f"[c{i}]"
+
+    cmd = [
+        "ffmpeg",
+        "-y",
+        *_decode_args(use_gpu, device_frames),
+        *_input_args(input_path),
+        "-filter_complex",
+        ";".join(filters),
+    ]
+    if mezzanine_path:
+        cmd += _mezzanine_output_args("[mz]", mezzanine_path, use_gpu, fps)
+
+    audio_filter = _loudnorm_filter(loudness)
+    keyframe_args = _keyframe_args(fps, HLS_SEGMENT_DURATION)
+    for label, (variant_name, settings) in zip(labels, variants):
+        variant_dir = os.path.join(output_dir, variant_name)
+        playlist_path = os.path.join(variant_dir, "index.m3u8")
+        cmd += _hls_output_args(
+            label,
+            variant_dir,
+            playlist_path,
+            settings,
+            use_gpu,
+            audio_filter,
+            keyframe_args,
+        )
+
+    return cmd
+
+
+def _encode_hls_ladder(
+    input_path: str,
+    output_dir: str,
+    variants: list[tuple[str, dict]],
+    use_gpu: bool,
+    loudness: dict[str, float] | None = None,
+    fps: float | None = None,
+    mezzanine_path: str | None = None,
 ) -> None:
-    """Encode a single HLS variant with GPU → CPU fallback."""
-    if use_gpu:
-        try:
-            run_ffmpeg(
-                _build_hls_variant_cmd(
-                    input_path, variant_dir, playlist_path, settings, use_gpu=True
-                ),
-                timeout=3600,
-                description=f"HLS {variant_name} (GPU)",
-            )
-            return
-        except RuntimeError as e:
-            print(f"GPU failed for {variant_name}, falling back to CPU: {e}")
+    """Encode all HLS variants in a single pass with GPU → CPU fallback.
 
-    run_ffmpeg(
-        _build_hls_variant_cmd(
-            input_path, variant_dir, playlist_path, settings, use_gpu=False
+    `mezzanine_path` adds the mezzanine as one more output of the same pass;
+    it then shares the ladder's fallback, and the pass gets the time budget
+    the separate mezzanine and ladder encodes had between them.
+    """
+    names = "/".join(name for name, _ in variants)
+    timeout = ENCODE_TIMEOUT
+    if mezzanine_path:
+        names = f"mezzanine + {names}"
+        timeout += ENCODE_TIMEOUT
+
+    _run_encode(
+        lambda gpu, device_frames: _build_hls_ladder_cmd(
+            input_path,
+            output_dir,
+            variants,
+            use_gpu=gpu,
+            loudness=loudness,
+            fps=fps,
+            mezzanine_path=mezzanine_path,
+            device_frames=device_frames,
         ),
-        timeout=3600,
-        description=f"HLS {variant_name} (CPU)",
+        use_gpu,
+        timeout=timeout,
+        description=f"HLS {names}",
     )
 
 
@@ -675,16 +1086,21 @@ def transcode_video_hls(
     output_dir: str,
     source_height: int | None,
     use_gpu: bool,
+    loudness: dict[str, float] | None = None,
+    fps: float | None = None,
+    mezzanine_path: str | None = None,
 ) -> list[str]:
     """Transcode video to multi-quality HLS variants.
 
     If source is smaller than all standard variants, produces a 'source'
     variant at the native resolution so the master playlist is never empty.
+    Pass `loudness` from `analyze_loudness` to normalize audio in a second pass,
+    and the source `fps` (see `get_frame_rate`) to fix the GOP length. With
+    `mezzanine_path` the same ffmpeg pass also writes the mezzanine.
     """
     print("Transcoding video to HLS variants...")
 
-    ready_variants = []
-    variant_playlists = []
+    variant_playlists: list[tuple[str, dict]] = []
 
     for variant_name, settings in HLS_VARIANTS.items():
         if source_height and settings["height"] > source_height:
@@ -692,20 +1108,10 @@ def transcode_video_hls(
                 f"Skipping {variant_name} (source height {source_height} < {settings['height']})"
             )
             continue
-
-        variant_dir = os.path.join(output_dir, variant_name)
-        os.makedirs(variant_dir, exist_ok=True)
-        playlist_path = os.path.join(variant_dir, "index.m3u8")
-
-        print(f"Encoding {variant_name}...")
-        _encode_hls_variant(
-            input_path, variant_dir, playlist_path, settings, variant_name, use_gpu
-        )
-        ready_variants.append(variant_name)
         variant_playlists.append((variant_name, settings))
 
     # Fallback: if source is smaller than all standard variants, encode at native resolution
-    if not ready_variants and source_height is not None:
+    if not variant_playlists and source_height is not None:
         print(
             f"No standard variants fit source ({source_height}p). Encoding 'source' variant..."
         )
@@ -714,15 +1120,26 @@ def transcode_video_hls(
             "video_bitrate": "800k",
             "audio_bitrate": "64k",
         }
-        variant_dir = os.path.join(output_dir, "source")
-        os.makedirs(variant_dir, exist_ok=True)
-        playlist_path = os.path.join(variant_dir, "index.m3u8")
+        variant_playlists.append(("source", settings))
 
-        _encode_hls_variant(
-            input_path, variant_dir, playlist_path, settings, "source", use_gpu
+    if variant_playlists:
+        for variant_name, _ in variant_playlists:
+            os.makedirs(os.path.join(output_dir, variant_name), exist_ok=True)
+
+        print(f"Encoding {'/'.join(name for name, _ in variant_playlists)}...")
+        _encode_hls_ladder(
+            input_path,
+            output_dir,
+            variant_playlists,
+            use_gpu,
+            loudness,
+            fps,
+            mezzanine_path,
         )
-        ready_variants.append("source")
-        variant_playlists.append(("source", settings))
+    elif mezzanine_path:
+        create_mezzanine(input_path, mezzanine_path, use_gpu, fps)
+
+    ready_variants = [variant_name for variant_name, _ in variant_playlists]
 
     # Generate master playlist
     master_path = os.path.join(output_dir, "master.m3u8")
@@ -740,46 +1157,91 @@ def transcode_video_hls(
     return ready_variants
 
 
-def transcode_audio_hls(input_path: str, output_dir: str) -> list[str]:
-    """Transcode audio to HLS variants."""
-    print("Transcoding audio to HLS variants...")
+def create_all_outputs(
+    input_path: str,
+    mezzanine_path: str,
+    output_dir: str,
+    source_height: int | None,
+    use_gpu: bool,
+    loudness: dict[str, float] | None = None,
+    fps: float | None = None,
+) -> list[str]:
+    """Create the mezzanine and the HLS ladder from one decode of the source.
 
-    variant_playlists = []
+    Same outputs as `create_mezzanine` followed by `transcode_video_hls`;
+    returns the ready HLS variant names.
+    """
+    return transcode_video_hls(
+        input_path,
+        output_dir,
+        source_height,
+        use_gpu,
+        loudness,
+        fps,
+        mezzanine_path=mezzanine_path,
+    )
 
-    for variant_name, settings in AUDIO_VARIANTS.items():
-        variant_dir = os.path.join(output_dir, variant_name)
-        os.makedirs(variant_dir, exist_ok=True)
-        playlist_path = os.path.join(variant_dir, "index.m3u8")
 
-        print(f"Encoding audio {variant_name}...")
+def _encode_audio_variant(
+    input_path: str,
+    output_dir: str,
+    variant_name: str,
+    settings: dict,
+    audio_filter: str,
+) -> None:
+    """Encode a single audio-only HLS variant."""
+    variant_dir = os.path.join(output_dir, variant_name)
+    os.makedirs(variant_dir, exist_ok=True)
+    playlist_path = os.path.join(variant_dir, "index.m3u8")
 
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-i",
-            input_path,
-            "-vn",
-            "-c:a",
-            "aac",
-            "-b:a",
-            settings["audio_bitrate"],
-            "-af",
-            "loudnorm=I=-16:TP=-1.5:LRA=11",
-            "-f",
-            "hls",
-            "-hls_time",
-            str(HLS_SEGMENT_DURATION),
-            "-hls_playlist_type",
-            "vod",
-            "-hls_flags",
-            "single_file",
-            "-hls_segment_filename",
-            os.path.join(variant_dir, "stream.ts"),
-            playlist_path,
-        ]
+    print(f"Encoding audio {variant_name}...")
 
-        run_ffmpeg(cmd, timeout=600, description=f"audio HLS {variant_name}")
-        variant_playlists.append((variant_name, settings))
+    cmd = [
+        "ffmpeg",
+        "-y",
+        *_input_args(input_path),
+        "-vn",
+        "-c:a",
+        "aac",
+        "-b:a",
+        settings["audio_bitrate"],
+        "-af",
+        audio_filter,
+        *_HLS_MUXER_ARGS,
+        os.path.join(variant_dir, "stream.ts"),
+        playlist_path,
+    ]
+
+    run_ffmpeg(cmd, timeout=600, description=f"audio HLS {variant_name}")
+
+
+def transcode_audio_hls(
+    input_path: str, output_dir: str, loudness: dict[str, float] | None = None
+) -> list[str]:
+    """Transcode audio to HLS variants (second-pass loudnorm when measured).
+
+    Each rung is a single-threaded AAC encode, so the rungs run as concurrent
+    ffmpeg processes rather than one after another.
+    """
+    print("Transcoding audio to HLS variants...")
+
+    audio_filter = _loudnorm_filter(loudness)
+    variant_playlists = list(AUDIO_VARIANTS.items())
+
+    with ThreadPoolExecutor(max_workers=len(variant_playlists)) as pool:
+        futures = [
+            pool.submit(
+                _encode_audio_variant,
+                input_path,
+                output_dir,
+                variant_name,
+                settings,
+                audio_filter,
+            )
+            for variant_name, settings in variant_playlists
+        ]
+    for future in futures:
+        future.result()
 
     # Generate master playlist
     master_path = os.path.join(output_dir, "master.m3u8")
@@ -808,86 +1270,139 @@ def _build_preview_cmd(
     start_time: int,
     preview_duration: int,
     use_gpu: bool,
+    device_frames: bool = False,
 ) -> list[str]:
     """Build ffmpeg command for preview clip (single-file HLS, see variant cmd)."""
     segment_path = os.path.join(preview_dir, "stream.ts")
     playlist_path = os.path.join(preview_dir, "preview.m3u8")
 
-    if use_gpu:
-        return [
-            "ffmpeg",
-            "-y",
-            "-hwaccel",
-            "cuda",
-            "-ss",
-            str(start_time),
-            "-i",
-            input_path,
-            "-t",
-            str(preview_duration),
-            "-vf",
-            f"scale=-2:{PREVIEW_HEIGHT}",
-            "-c:v",
-            "h264_nvenc",
-            "-preset",
-            "p4",
-            "-cq",
-            "23",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-f",
-            "hls",
-            "-hls_time",
-            str(HLS_SEGMENT_DURATION),
-            "-hls_playlist_type",
-            "vod",
-            "-hls_flags",
-            "single_file",
-            "-hls_segment_filename",
-            segment_path,
-            playlist_path,
-        ]
     return [
         "ffmpeg",
         "-y",
+        *_decode_args(use_gpu, device_frames),
         "-ss",
         str(start_time),
-        "-i",
-        input_path,
+        *_input_args(input_path),
         "-t",
         str(preview_duration),
         "-vf",
-        f"scale=-2:{PREVIEW_HEIGHT}",
-        "-c:v",
-        "libx264",
-        "-preset",
-        "fast",
-        "-crf",
-        "23",
+        _scale_filter(PREVIEW_HEIGHT, device_frames),
+        *(_nvenc_args(cq=23) if use_gpu else _X264_DELIVERY_ARGS),
         "-c:a",
         "aac",
         "-b:a",
         "128k",
-        "-f",
-        "hls",
-        "-hls_time",
-        str(HLS_SEGMENT_DURATION),
-        "-hls_playlist_type",
-        "vod",
-        "-hls_flags",
-        "single_file",
-        "-hls_segment_filename",
+        *_HLS_MUXER_ARGS,
         segment_path,
         playlist_path,
     ]
 
 
+def _read_byterange_playlist(
+    playlist_path: str,
+) -> list[tuple[float, int, int]] | None:
+    """Parse a single-file HLS playlist into (duration, length, offset) segments.
+
+    Returns None unless every segment is a byte range of `stream.ts`.
+    """
+    segments: list[tuple[float, int, int]] = []
+    seg_duration: float | None = None
+    byterange: tuple[int, int] | None = None
+    next_offset = 0
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                seg_duration = float(line[len("#EXTINF:") :].split(",", 1)[0])
+            elif line.startswith("#EXT-X-BYTERANGE:"):
+                length, _, offset = line[len("#EXT-X-BYTERANGE:") :].partition("@")
+                byterange = (int(length), int(offset) if offset else next_offset)
+            elif line and not line.startswith("#"):
+                if line != "stream.ts" or seg_duration is None or byterange is None:
+                    return None
+                segments.append((seg_duration, *byterange))
+                next_offset = byterange[0] + byterange[1]
+                seg_duration, byterange = None, None
+    return segments or None
+
+
+def _cut_preview_from_variant(
+    output_dir: str, preview_dir: str, start_time: int, preview_duration: int
+) -> bool:
+    """Build the preview from the already-encoded 720p rung, without encoding.
+
+    The segments covering the preview window are copied out of the rung's
+    `stream.ts` into the preview's own `stream.ts` — the preview is public, so
+    its playlist must never point into the full-length variant. Returns False
+    (caller encodes instead) when there is no 720p rung or its playlist isn't
+    a single-file byte-range playlist.
+    """
+    variant_name = next(
+        (n for n, v in HLS_VARIANTS.items() if v["height"] == PREVIEW_HEIGHT), None
+    )
+    if variant_name is None:
+        return False
+    variant_dir = os.path.join(output_dir, variant_name)
+    playlist_path = os.path.join(variant_dir, "index.m3u8")
+    if not os.path.exists(playlist_path):
+        return False
+    try:
+        segments = _read_byterange_playlist(playlist_path)
+    except ValueError:
+        segments = None
+    if segments is None:
+        return False
+
+    # Segments are keyframe-aligned, so the window starts at the segment
+    # containing start_time and runs until preview_duration is covered.
+    window: list[tuple[float, int, int]] = []
+    elapsed = 0.0
+    covered = 0.0
+    for seg_duration, length, offset in segments:
+        if elapsed + seg_duration > start_time:
+            window.append((seg_duration, length, offset))
+            covered += seg_duration
+            if covered >= preview_duration:
+                break
+        elapsed += seg_duration
+    if not window:
+        return False
+
+    first_offset = window[0][2]
+    total_bytes = window[-1][2] + window[-1][1] - first_offset
+    with open(os.path.join(variant_dir, "stream.ts"), "rb") as src, open(
+        os.path.join(preview_dir, "stream.ts"), "wb"
+    ) as dst:
+        src.seek(first_offset)
+        dst.write(src.read(total_bytes))
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:4",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(d for d, _, _ in window))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for seg_duration, length, offset in window:
+        lines += [
+            f"#EXTINF:{seg_duration:.6f},",
+            f"#EXT-X-BYTERANGE:{length}@{offset - first_offset}",
+            "stream.ts",
+        ]
+    lines.append("#EXT-X-ENDLIST")
+    with open(os.path.join(preview_dir, "preview.m3u8"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return True
+
+
 def create_preview(
     input_path: str, output_dir: str, duration: int, use_gpu: bool
 ) -> None:
-    """Create 30-second preview clip at 720p with GPU → CPU fallback."""
+    """Create 30-second preview clip at 720p.
+
+    Cut from the 720p HLS rung in `output_dir` when there is one (no encode);
+    otherwise encoded from the source with GPU → CPU fallback.
+    """
     print("Creating preview clip...")
 
     preview_dir = os.path.join(output_dir, "preview")
@@ -896,25 +1411,16 @@ def create_preview(
     start_time = max(0, int(duration * 0.1))
     preview_duration = min(PREVIEW_DURATION, duration - start_time)
 
-    if use_gpu:
-        try:
-            run_ffmpeg(
-                _build_preview_cmd(
-                    input_path, preview_dir, start_time, preview_duration, use_gpu=True
-                ),
-                timeout=120,
-                description="preview (GPU)",
-            )
-            return
-        except RuntimeError as e:
-            print(f"GPU preview failed, falling back to CPU: {e}")
+    if _cut_preview_from_variant(output_dir, preview_dir, start_time, preview_duration):
+        return
 
-    run_ffmpeg(
-        _build_preview_cmd(
-            input_path, preview_dir, start_time, preview_duration, use_gpu=False
+    _run_encode(
+        lambda gpu, device_frames: _build_preview_cmd(
+            input_path, preview_dir, start_time, preview_duration, gpu, device_frames
         ),
-        timeout=120,
-        description="preview (CPU)",
+        use_gpu,
+        timeout=PREVIEW_TIMEOUT,
+        description="preview",
     )
 
 
@@ -929,8 +1435,7 @@ def extract_thumbnail(input_path: str, output_path: str, duration: int) -> None:
         "-y",
         "-ss",
         str(timestamp),
-        "-i",
-        input_path,
+        *_input_args(input_path),
         "-vframes",
         "1",
         "-q:v",
@@ -938,7 +1443,15 @@ def extract_thumbnail(input_path: str, output_path: str, duration: int) -> None:
         output_path,
     ]
 
-    run_ffmpeg(cmd, timeout=60, description="thumbnail extraction")
+    run_ffmpeg(cmd, timeout=THUMBNAIL_TIMEOUT, description="thumbnail extraction")
+
+
+def _safe_getsize(path: str) -> int:
+    """File size for logging; 0 if the file is missing or unreadable."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 
 # Allowed thumbnail sizes - must match THUMBNAIL_SIZES in @codex/validation
@@ -979,22 +1492,36 @@ def extract_thumbnail_variants(
         if size_name not in ALLOWED_THUMBNAIL_SIZES:
             raise ValueError(f"Invalid thumbnail size: {size_name}")
 
-    variants = {}
+    # Seek and decode the frame once; split hands it to one scaler + WebP
+    # encoder per size, all written by the same ffmpeg invocation.
+    labels = [f"[t{i}]" for i in range(len(sizes))]
+    scales = [f"scale={config['width']}:-1" for config in sizes.values()]
+    if len(sizes) == 1:
+        filter_graph = f"[0:v]{scales[0]}{labels[0]}"
+    else:
+        split_labels = "".join(f"[s{i}]" for i in range(len(sizes)))
+        filter_graph = ";".join(
+            [f"[0:v]split={len(sizes)}{split_labels}"]
+            + [f"[s{i}]{scale}{labels[i]}" for i, scale in enumerate(scales)]
+        )
 
-    for size_name, config in sizes.items():
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(timestamp),
+        *_input_args(input_path),
+        "-filter_complex",
+        filter_graph,
+    ]
+    variants = {}
+    for label, (size_name, config) in zip(labels, sizes.items()):
         output_path = os.path.join(output_dir, f"thumbnail-{size_name}.webp")
-
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-ss",
-            str(timestamp),
-            "-i",
-            input_path,
-            "-vframes",
+        cmd += [
+            "-map",
+            label,
+            "-frames:v",
             "1",
-            "-vf",
-            f"scale={config['width']}:-1",
             "-c:v",
             "libwebp",
             "-quality",
@@ -1003,51 +1530,97 @@ def extract_thumbnail_variants(
             str(config["compression"]),
             output_path,
         ]
-
-        run_ffmpeg(cmd, timeout=60, description=f"thumbnail {size_name}")
         variants[size_name] = output_path
 
-        file_size = os.path.getsize(output_path)
-        print(f"  {size_name}: {file_size} bytes")
+    run_ffmpeg(
+        cmd, timeout=THUMBNAIL_TIMEOUT, description=f"thumbnails {'/'.join(sizes)}"
+    )
+
+    for size_name, output_path in variants.items():
+        print(f"  {size_name}: {_safe_getsize(output_path)} bytes")
 
     return variants
 
 
 def generate_waveform(
-    input_path: str, json_path: str, image_path: str | None = None
+    input_path: str,
+    json_path: str,
+    image_path: str | None = None,
+    duration: int = 0,
 ) -> None:
     """Generate audio waveform JSON (always) and optional PNG image.
 
     Pass image_path=None to skip PNG generation — the JSON is the
     canonical data consumed by the audio player; the PNG is a static
     preview currently unused on the frontend.
+
+    When the PNG is wanted, the audio is decoded once into a binary `.dat`
+    waveform and both outputs are rendered from that instead of decoding the
+    source twice.
     """
     print("Generating audio waveform...")
 
-    cmd_json = [
+    if image_path is None:
+        cmd_json = [
+            "audiowaveform",
+            "-i",
+            input_path,
+            "-o",
+            json_path,
+            "--pixels-per-second",
+            str(WAVEFORM_PIXELS_PER_SECOND),
+            "-b",
+            "8",
+        ]
+        run_ffmpeg(cmd_json, timeout=120, description="waveform JSON")
+        return
+
+    # audiowaveform can only downsample waveform data, so the .dat must be at
+    # least as detailed as the PNG (WAVEFORM_IMAGE_WIDTH points in total).
+    dat_pixels_per_second = max(
+        WAVEFORM_PIXELS_PER_SECOND,
+        math.ceil(WAVEFORM_IMAGE_WIDTH / max(duration, 1)),
+    )
+    dat_path = os.path.splitext(json_path)[0] + ".dat"
+
+    cmd_dat = [
         "audiowaveform",
         "-i",
         input_path,
         "-o",
-        json_path,
+        dat_path,
         "--pixels-per-second",
-        "10",
+        str(dat_pixels_per_second),
         "-b",
         "8",
     ]
-    run_ffmpeg(cmd_json, timeout=120, description="waveform JSON")
+    run_ffmpeg(cmd_dat, timeout=120, description="waveform data")
 
-    if image_path is None:
-        return
+    # Given a .dat input, --pixels-per-second resamples the data down to the
+    # JSON resolution the player expects.
+    cmd_json = [
+        "audiowaveform",
+        "-i",
+        dat_path,
+        "-o",
+        json_path,
+        "--pixels-per-second",
+        str(WAVEFORM_PIXELS_PER_SECOND),
+    ]
+    run_ffmpeg(cmd_json, timeout=120, description="waveform JSON")
 
+    # --zoom auto fits the whole track into --width; the default zoom (256
+    # samples/pixel) is finer than the .dat and audiowaveform rejects it.
     cmd_png = [
         "audiowaveform",
         "-i",
-        input_path,
+        dat_path,
         "-o",
         image_path,
+        "--zoom",
+        "auto",
         "--width",
-        "1800",
+        str(WAVEFORM_IMAGE_WIDTH),
         "--height",
         "140",
         "--colors",
@@ -1061,21 +1634,28 @@ def generate_waveform(
 # =============================================================================
 
 
-def sign_payload(payload: str, secret: str, timestamp: str | None = None) -> str:
+# Reused across webhooks so progress/completion posts share one keep-alive
+# connection instead of paying a TCP + TLS handshake each time.
+_HTTP_SESSION = requests.Session()
+
+
+def sign_payload(payload: bytes, secret: bytes, timestamp: str | None = None) -> str:
     """Generate HMAC-SHA256 signature for webhook payload.
 
     If timestamp is provided, signs 'timestamp.payload' to match
-    the server's signature format for replay protection.
+    the server's signature format for replay protection. Takes the exact
+    bytes that will be sent so nothing is re-encoded for signing.
     """
-    message = f"{timestamp}.{payload}" if timestamp else payload
-    return hmac.new(
-        secret.encode("utf-8"),
-        message.encode("utf-8"),
-        hashlib.sha256,
-    ).hexdigest()
+    message = f"{timestamp}.".encode("ascii") + payload if timestamp else payload
+    return hmac.digest(secret, message, "sha256").hex()
+
+
+def _encode_payload(payload: dict[str, Any]) -> bytes:
+    """Compact JSON body for a webhook; signed and sent as-is."""
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
 
 
-def send_webhook(url: str, secret: str, result: dict) -> None:
+def send_webhook(url: str, secret: bytes, result: dict) -> None:
     """Send signed webhook with retry (3 attempts, exponential backoff).
 
     On exhaustion, raises RuntimeError so RunPod can retry the entire job.
@@ -1083,7 +1663,7 @@ def send_webhook(url: str, secret: str, result: dict) -> None:
     max_attempts = 3
     backoff_base = 2
 
-    payload = json.dumps(result)
+    payload = _encode_payload(result)
     timestamp = str(int(time.time()))
     signature = sign_payload(payload, secret, timestamp)
     headers = {
@@ -1095,7 +1675,9 @@ def send_webhook(url: str, secret: str, result: dict) -> None:
     last_error: Exception | None = None
     for attempt in range(max_attempts):
         try:
-            response = requests.post(url, data=payload, headers=headers, timeout=30)
+            response = _HTTP_SESSION.post(
+                url, data=payload, headers=headers, timeout=30
+            )
             response.raise_for_status()
             print(f"Webhook sent successfully (attempt {attempt + 1})")
             return
@@ -1112,7 +1694,7 @@ def send_webhook(url: str, secret: str, result: dict) -> None:
 
 
 def send_progress(
-    url: str, secret: str, job_id: str, step: str, percent: int, media_id: str = ""
+    url: str, secret: bytes, job_id: str, step: str, percent: int, media_id: str = ""
 ) -> None:
     """Send a progress update webhook. Fire-and-forget: failures are logged but don't stop the job."""
     payload_dict: dict[str, Any] = {
@@ -1123,7 +1705,7 @@ def send_progress(
     }
     if media_id:
         payload_dict["mediaId"] = media_id
-    payload = json.dumps(payload_dict)
+    payload = _encode_payload(payload_dict)
     try:
         timestamp = str(int(time.time()))
         signature = sign_payload(payload, secret, timestamp)
@@ -1132,11 +1714,41 @@ def send_progress(
             "X-Runpod-Signature": signature,
             "X-Runpod-Timestamp": timestamp,
         }
-        requests.post(url, data=payload, headers=headers, timeout=5)
+        _HTTP_SESSION.post(url, data=payload, headers=headers, timeout=5)
     except Exception as e:
         print(f"Progress webhook failed (non-fatal): {e}")
 
 
+# =============================================================================
+# Work Directory Cleanup
+# =============================================================================
+
+# Scratch-dir deletions still running; joined before the worker exits
+_CLEANUP_THREADS: set[threading.Thread] = set()
+
+
+def _remove_work_dir(work_dir: str) -> None:
+    """Delete a job's scratch directory without holding up the handler.
+
+    Multi-GB sources and outputs take a while to unlink; the handler returns
+    (and RunPod releases the worker) while this runs.
+    """
+
+    def remove() -> None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        _CLEANUP_THREADS.discard(thread)
+
+    thread = threading.Thread(target=remove, name="work-dir-cleanup")
+    _CLEANUP_THREADS.add(thread)
+    thread.start()
+
+
+@atexit.register
+def _join_cleanup_threads() -> None:
+    for thread in list(_CLEANUP_THREADS):
+        thread.join()
+
+
 # =============================================================================
 # Main Handler
 # =============================================================================
@@ -1199,6 +1811,8 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
     webhook_secret = os.environ.get("WEBHOOK_SECRET", "")
     if not webhook_secret:
         raise ValueError("WEBHOOK_SECRET not configured in environment.")
+    # Encoded once; every progress/completion webhook signs with these bytes
+    signing_key = webhook_secret.encode("utf-8")
 
     # --- Storage clients ---
     r2_client = create_s3_client(r2_endpoint, r2_access_key_id, r2_secret_access_key)
@@ -1212,21 +1826,44 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
     print(f"GPU available: {use_gpu}")
 
     # --- Processing ---
-    work_dir = tempfile.mkdtemp(prefix="transcoding_")
+    work_dir = tempfile.mkdtemp(prefix="transcoding_", dir=WORK_DIR_ROOT)
     uploaded_keys: list[tuple[Any, str, str]] = []
+    # HLS output uploads here while thumbnails/waveform are still being made
+    background = ThreadPoolExecutor(max_workers=1)
+    hls_upload: Future[list[tuple[Any, str, str]]] | None = None
 
     try:
-        # Step 1: Download original from R2
-        send_progress(webhook_url, webhook_secret, job_id, "downloading", 0, media_id)
-        input_ext = os.path.splitext(input_key)[1] or ".mp4"
-        input_path = os.path.join(work_dir, f"input{input_ext}")
-        download_file(r2_client, r2_bucket_name, input_key, input_path)
+        # Step 1: Locate the original — stream video from a presigned R2 URL
+        # when enabled (falling back if the endpoint refuses it), else download.
+        send_progress(webhook_url, signing_key, job_id, "downloading", 0, media_id)
+        input_path: str | None = None
+        probe_data: dict[str, Any] | None = None
+        if FEATURES["stream_input"] and media_type == "video":
+            input_url = presign_input_url(r2_client, r2_bucket_name, input_key)
+            try:
+                probe_data = probe_media(input_url)
+                input_path = input_url
+            except RuntimeError as e:
+                print(
+                    "Streaming input unavailable, downloading instead: "
+                    f"{_redact_urls(str(e))}"
+                )
+
+        if input_path is None:
+            input_ext = os.path.splitext(input_key)[1] or ".mp4"
+            input_path = os.path.join(work_dir, f"input{input_ext}")
+            download_file(r2_client, r2_bucket_name, input_key, input_path)
 
         # Step 2: Probe metadata
-        send_progress(webhook_url, webhook_secret, job_id, "probing", 5, media_id)
-        probe_data = probe_media(input_path)
+        send_progress(webhook_url, signing_key, job_id, "probing", 5, media_id)
+        if probe_data is None:
+            probe_data = probe_media(input_path)
         duration, width, height = get_media_info(probe_data)
-        print(f"Media info: duration={duration}s, width={width}, height={height}")
+        fps = get_frame_rate(probe_data)
+        print(
+            f"Media info: duration={duration}s, width={width}, height={height}, "
+            f"fps={fps}"
+        )
 
         if duration <= 0:
             raise ValueError(
@@ -1235,24 +1872,23 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
 
         validate_streams(probe_data, media_type)
 
-        # Step 3: Create mezzanine → Upload to B2 (gated)
+        # Step 3: Mezzanine (gated) — encoded alongside the HLS ladder in
+        # step 5 so the source is only decoded once
+        mezzanine_path = None
         mezzanine_key = None
         if FEATURES["mezzanine"] and media_type == "video":
-            send_progress(webhook_url, webhook_secret, job_id, "mezzanine", 6, media_id)
+            send_progress(webhook_url, signing_key, job_id, "mezzanine", 6, media_id)
             mezzanine_path = os.path.join(work_dir, "mezzanine.mp4")
             mezzanine_key = f"{creator_id}/mezzanine/{media_id}/mezzanine.mp4"
-            create_mezzanine(input_path, mezzanine_path, use_gpu)
-            upload_file(
-                b2_client, b2_bucket_name, mezzanine_key, mezzanine_path, "video/mp4"
-            )
-            uploaded_keys.append((b2_client, b2_bucket_name, mezzanine_key))
 
-        # Step 4: Loudness analysis (gated — stats only, not fed back to encoder)
+        # Step 4: Loudness analysis (gated — measurements also drive the
+        # second-pass loudnorm in the HLS encodes)
+        loudness: dict[str, float] | None = None
         loudness_integrated: int | None = None
         loudness_peak: int | None = None
         loudness_range: int | None = None
         if FEATURES["loudness_analysis"]:
-            send_progress(webhook_url, webhook_secret, job_id, "loudness", 15, media_id)
+            send_progress(webhook_url, signing_key, job_id, "loudness", 15, media_id)
             loudness = analyze_loudness(input_path)
             print(f"Loudness: {loudness}")
             loudness_integrated = max(-10000, min(1000, int(loudness["input_i"] * 100)))
@@ -1261,36 +1897,46 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
 
         # Step 5: Transcode HLS variants
         send_progress(
-            webhook_url, webhook_secret, job_id, "encoding_variants", 17, media_id
+            webhook_url, signing_key, job_id, "encoding_variants", 17, media_id
         )
         hls_dir = os.path.join(work_dir, "hls")
         os.makedirs(hls_dir, exist_ok=True)
 
-        if media_type == "video":
-            ready_variants = transcode_video_hls(input_path, hls_dir, height, use_gpu)
+        if mezzanine_path:
+            ready_variants = create_all_outputs(
+                input_path, mezzanine_path, hls_dir, height, use_gpu, loudness, fps
+            )
+            upload_file(
+                b2_client, b2_bucket_name, mezzanine_key, mezzanine_path, "video/mp4"
+            )
+            uploaded_keys.append((b2_client, b2_bucket_name, mezzanine_key))
+        elif media_type == "video":
+            ready_variants = transcode_video_hls(
+                input_path, hls_dir, height, use_gpu, loudness, fps
+            )
         else:
-            ready_variants = transcode_audio_hls(input_path, hls_dir)
+            ready_variants = transcode_audio_hls(input_path, hls_dir, loudness)
 
         # Step 6: Create preview BEFORE uploading HLS dir (preview goes into hls_dir)
         hls_preview_key = None
         preview_generated = False
         if FEATURES["video_preview"] and media_type == "video" and duration > 0:
-            send_progress(webhook_url, webhook_secret, job_id, "preview", 72, media_id)
+            send_progress(webhook_url, signing_key, job_id, "preview", 72, media_id)
             create_preview(input_path, hls_dir, duration, use_gpu)
             preview_generated = True
 
-        # Upload HLS to R2 (includes preview if generated above)
+        # Upload HLS to R2 in the background (includes preview if generated
+        # above); it is joined before the result is reported.
         hls_prefix = f"{creator_id}/hls/{media_id}/"
-        hls_uploaded = upload_directory_tracked(
-            r2_client, r2_bucket_name, hls_prefix, hls_dir
+        hls_upload = background.submit(
+            upload_directory_tracked, r2_client, r2_bucket_name, hls_prefix, hls_dir
         )
-        uploaded_keys.extend(hls_uploaded)
         hls_master_key = f"{hls_prefix}master.m3u8"
         if preview_generated:
             hls_preview_key = f"{hls_prefix}preview/preview.m3u8"
 
         # Step 7: Extract thumbnail variants (video only)
-        send_progress(webhook_url, webhook_secret, job_id, "thumbnails", 77, media_id)
+        send_progress(webhook_url, signing_key, job_id, "thumbnails", 77, media_id)
         thumbnail_key = None
         thumbnail_variants = None
         if media_type == "video" and duration > 0:
@@ -1313,7 +1959,7 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
         # Step 8: Generate waveform (audio only)
         send_progress(
             webhook_url,
-            webhook_secret,
+            signing_key,
             job_id,
             "waveform" if media_type == "audio" else "uploading_outputs",
             80,
@@ -1328,7 +1974,9 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
                 if FEATURES["waveform_image"]
                 else None
             )
-            generate_waveform(input_path, waveform_json_path, waveform_png_path)
+            generate_waveform(
+                input_path, waveform_json_path, waveform_png_path, duration
+            )
 
             waveform_key = f"{creator_id}/waveforms/{media_id}/waveform.json"
             upload_file(
@@ -1351,6 +1999,10 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
                 )
                 uploaded_keys.append((r2_client, r2_bucket_name, waveform_image_key))
 
+        # Wait for the HLS upload before reporting it
+        uploaded_keys.extend(hls_upload.result())
+        hls_upload = None
+
         # Build result — field names must match runpodWebhookOutputSchema
         result: WebhookOutput = {
             "mediaId": media_id,
@@ -1372,20 +2024,29 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
         }
 
         # Step 10: Send completion webhook
-        send_progress(webhook_url, webhook_secret, job_id, "finalizing", 95, media_id)
+        send_progress(webhook_url, signing_key, job_id, "finalizing", 95, media_id)
         webhook_payload = {
             "jobId": job_id,
             "status": "completed",
             "output": result,
         }
-        send_webhook(webhook_url, webhook_secret, webhook_payload)
+        send_webhook(webhook_url, signing_key, webhook_payload)
 
         return {"status": "success", "mediaId": media_id}
 
     except Exception as e:
-        error_msg = str(e)
+        # e.g. TimeoutExpired repeats the whole argv, presigned input URL included
+        error_msg = _redact_urls(str(e))
         print(f"Transcoding failed: {error_msg}")
 
+        # Let an in-flight HLS upload settle so its keys are cleaned up too
+        # (a failed one has already removed its own partial uploads)
+        if hls_upload is not None:
+            try:
+                uploaded_keys.extend(hls_upload.result())
+            except Exception:
+                pass
+
         # Clean up any partial uploads
         if uploaded_keys:
             print(f"Cleaning up {len(uploaded_keys)} uploaded files...")
@@ -1400,7 +2061,7 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
                 "error": error_msg[:2000],
                 "mediaId": media_id,
             }
-            send_webhook(webhook_url, webhook_secret, webhook_payload)
+            send_webhook(webhook_url, signing_key, webhook_payload)
         except Exception as webhook_error:
             print(f"Failed to send error webhook: {webhook_error}")
             # Re-raise so RunPod surfaces this as an exception in its error logs
@@ -1410,7 +2071,8 @@ def handler(job: dict[str, Any]) -> dict[str, Any]:
         return {"status": "error", "error": error_msg}
 
     finally:
-        shutil.rmtree(work_dir, ignore_errors=True)
+        background.shutdown(wait=True)
+        _remove_work_dir(work_dir)
 
 
 # RunPod serverless entry point
@@ -0,0 +1,196 @@
+"""Shared RunPod GraphQL client for the endpoint scripts.
+
+Pooled keep-alive sessions (lookups and mutations retry differently),
+`run_query`, and every GraphQL document the scripts send, minified once at
+import.
+"""
+
+import json
+import re
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL = "https://api.runpod.io/graphql"
+
+
+def _session(retry):
+    """Keep-alive session to the RunPod API with the given retry policy."""
+    session = requests.Session()
+    session.mount(
+        "https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry)
+    )
+    return session
+
+
+# Read-only lookups: transient API errors are retried with backoff (0.3s,
+# 0.6s, 1.2s, 2.4s) instead of failing the whole CI run; GraphQL only uses
+# POST. The last response is still returned so its status is reported below.
+SESSION = _session(
+    Retry(
+        total=4,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+)
+
+# Mutations are not idempotent: a 502/504 or read timeout may come after the
+# server already saved (saveEndpoint without an id creates a new endpoint), so
+# only retry when the request was certainly not processed — connect errors
+# and 429 rate limiting.
+MUTATION_SESSION = _session(
+    Retry(
+        total=4,
+        connect=4,
+        read=0,
+        other=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+)
+
+# (connect, read): fail fast on a dead socket, allow slow responses
+REQUEST_TIMEOUT = (5, 30)
+
+
+def _minify(query):
+    """Collapse GraphQL whitespace — it is insignificant, so don't send it."""
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def _request_body(query):
+    """Encode a variable-free GraphQL query as a ready-to-send request body."""
+    return json.dumps({"query": _minify(query)}, separators=(",", ":")).encode()
+
+
+def run_query(query, variables=None, api_key=None):
+    """POST a GraphQL query and return its `data`; raise on any failure.
+
+    `query` may be a pre-encoded body (the lookup constants below).
+    """
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    session = SESSION
+    if isinstance(query, bytes):
+        body = query
+    else:
+        body = json.dumps(
+            {"query": query, "variables": variables}, separators=(",", ":")
+        ).encode()
+        if query.startswith("mutation"):
+            session = MUTATION_SESSION
+    response = session.post(
+        API_URL,
+        data=body,
+        headers=headers,
+        timeout=REQUEST_TIMEOUT,
+    )
+    if response.status_code != 200:
+        raise Exception(f"Query failed: {response.status_code} {response.text}")
+
+    data = response.json()
+    if "errors" in data:
+        raise Exception(f"GraphQL Errors: {data['errors']}")
+
+    return data["data"]
+
+
+# Mutations (sent with per-call variables)
+SAVE_TEMPLATE = _minify(
+    """
+    mutation saveTemplate($input: SaveTemplateInput!) {
+        saveTemplate(input: $input) {
+            id
+            name
+            imageName
+        }
+    }
+    """
+)
+SAVE_ENDPOINT = _minify(
+    """
+    mutation saveEndpoint($input: EndpointInput!) {
+        saveEndpoint(input: $input) {
+            id
+            name
+            gpuIds
+        }
+    }
+    """
+)
+
+# Fixed lookup queries, encoded once at import
+GET_USER_TEMPLATES = _request_body(
+    """
+    query getUserTemplates {
+        myself {
+            podTemplates {
+                id
+                name
+            }
+        }
+    }
+    """
+)
+GET_REGISTRY_AUTHS = _request_body(
+    """
+    query getUserRegistryAuths {
+        myself {
+            containerRegistryAuths {
+                id
+                username
+                registryId
+            }
+        }
+    }
+    """
+)
+GET_USER_RESOURCES = _request_body(
+    """
+    query getUserResources {
+        myself {
+            podTemplates {
+                id
+                name
+            }
+            containerRegistryAuths {
+                id
+                username
+                registryId
+            }
+        }
+    }
+    """
+)
+GET_ENDPOINTS_AND_TEMPLATES = _request_body(
+    """
+    query EndpointsAndTemplates {
+        myself {
+            endpoints {
+                id
+                name
+                templateId
+                gpuIds
+                workersMin
+                workersMax
+            }
+            podTemplates {
+                id
+                name
+                imageName
+                containerDiskInGb
+                volumeInGb
+                dockerArgs
+                env {
+                    key
+                    value
+                }
+            }
+        }
+    }
+    """
+)
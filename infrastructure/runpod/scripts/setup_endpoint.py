@@ -1,64 +1,123 @@
+import functools
+import hashlib
+import json
 import os
 import sys
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _gql import (
+    GET_REGISTRY_AUTHS,
+    GET_USER_RESOURCES,
+    GET_USER_TEMPLATES,
+    SAVE_ENDPOINT,
+    SAVE_TEMPLATE,
+    run_query,
+)
 
 # Configuration
-API_URL = "https://api.runpod.io/graphql"
 TEMPLATE_NAME = "codex-transcoder-template"
 ENDPOINT_NAME = "codex-transcoder-endpoint"
 # Using 24GB VRAM GPU (RTX 3090 / A10G class)
 GPU_ID = "AMPERE_24"
 IMAGE_NAME = "ghcr.io/brucemckayone/codex-transcoder:latest"
 
+# Template env vars — constant, so built once and sent as-is
+TEMPLATE_ENV = (
+    {"key": "RUNPOD_DEBUG", "value": "true"},
+    # B2 credentials from RunPod secret manager (not in job payload)
+    {"key": "B2_ENDPOINT", "value": "{{ RUNPOD_SECRET_b2_endpoint }}"},
+    {"key": "B2_ACCESS_KEY_ID", "value": "{{ RUNPOD_SECRET_b2_access_key_id }}"},
+    {
+        "key": "B2_SECRET_ACCESS_KEY",
+        "value": "{{ RUNPOD_SECRET_b2_secret_access_key }}",
+    },
+    {"key": "B2_BUCKET_NAME", "value": "{{ RUNPOD_SECRET_b2_bucket_name }}"},
+    # R2 credentials from RunPod secret manager (not in job payload)
+    {"key": "R2_ENDPOINT", "value": "{{ RUNPOD_SECRET_r2_endpoint }}"},
+    {"key": "R2_ACCESS_KEY_ID", "value": "{{ RUNPOD_SECRET_r2_access_key_id }}"},
+    {
+        "key": "R2_SECRET_ACCESS_KEY",
+        "value": "{{ RUNPOD_SECRET_r2_secret_access_key }}",
+    },
+    {"key": "R2_BUCKET_NAME", "value": "{{ RUNPOD_SECRET_r2_bucket_name }}"},
+    # Feature flags — toggle pipeline steps without a redeploy.
+    # Mezzanine is off until a consumer is wired up; others match
+    # current production behavior. See handler/main.py FEATURES dict.
+    {"key": "ENABLE_MEZZANINE", "value": "false"},
+    {"key": "ENABLE_LOUDNESS_ANALYSIS", "value": "true"},
+    {"key": "ENABLE_WAVEFORM_IMAGE", "value": "true"},
+    {"key": "ENABLE_THUMBNAIL_VARIANTS", "value": "true"},
+    {"key": "ENABLE_VIDEO_PREVIEW", "value": "true"},
+    {"key": "ENABLE_STREAM_INPUT", "value": "false"},
+)
 
-def run_query(query, variables=None, api_key=None):
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    response = requests.post(
-        API_URL,
-        json={"query": query, "variables": variables},
-        headers=headers,
-        timeout=30,
-    )
-    if response.status_code != 200:
-        raise Exception(f"Query failed: {response.status_code} {response.text}")
+# Lookups are cached on disk briefly so repeated runs (CI retries, several
+# endpoints) don't refetch lists that rarely change.
+CACHE_TTL_SECONDS = 300
+_CACHED_LOOKUPS = []
 
-    data = response.json()
-    if "errors" in data:
-        raise Exception(f"GraphQL Errors: {data['errors']}")
 
-    return data["data"]
+def _cache_path(name, api_key):
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return os.path.join(cache_root, "codex-runpod", f"{name}-{key_hash}.json")
 
 
-def get_user_templates(api_key):
-    query = """
-    query getUserTemplates {
-        myself {
-            podTemplates {
-                id
-                name
-            }
-        }
-    }
+def cached_lookup(func):
+    """Cache an api_key-scoped lookup as JSON for CACHE_TTL_SECONDS.
+
+    Only successful results are cached: a failed lookup raises through the
+    wrapper, so fallbacks must live outside the decorated function.
     """
-    data = run_query(query, api_key=api_key)
+    _CACHED_LOOKUPS.append(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(api_key):
+        path = _cache_path(func.__name__, api_key)
+        try:
+            if time.time() - os.path.getmtime(path) < CACHE_TTL_SECONDS:
+                with open(path) as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        result = func(api_key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(result, f)
+        except OSError:
+            pass
+        return result
+
+    return wrapper
+
+
+def invalidate_cache(api_key):
+    """Drop cached lookups after a mutation changed what they return."""
+    for name in _CACHED_LOOKUPS:
+        try:
+            os.unlink(_cache_path(name, api_key))
+        except FileNotFoundError:
+            pass
+
+
+@cached_lookup
+def get_user_templates(api_key):
+    data = run_query(GET_USER_TEMPLATES, api_key=api_key)
     return data["myself"]["podTemplates"]
 
 
+@cached_lookup
+def _fetch_registry_auths(api_key):
+    data = run_query(GET_REGISTRY_AUTHS, api_key=api_key)
+    return data["myself"]["containerRegistryAuths"]
+
+
 def get_registry_auths(api_key):
-    query = """
-    query getUserRegistryAuths {
-        myself {
-            containerRegistryAuths {
-                id
-                username
-                registryId
-            }
-        }
-    }
-    """
     try:
-        data = run_query(query, api_key=api_key)
-        return data["myself"]["containerRegistryAuths"]
+        return _fetch_registry_auths(api_key)
     except Exception:
         print(
             "⚠️  Could not fetch registry auths (query might differ). Skipping auto-link."
@@ -66,55 +125,38 @@ def get_registry_auths(api_key):
         return []
 
 
+@cached_lookup
+def _fetch_account_resources(api_key):
+    data = run_query(GET_USER_RESOURCES, api_key=api_key)
+    myself = data["myself"]
+    return myself["podTemplates"], myself["containerRegistryAuths"]
+
+
+def get_account_resources(api_key):
+    """Fetch templates and registry auths in one request.
+
+    Falls back to the separate lookups, run concurrently, if the combined
+    query is rejected (e.g. the registry auth fields differ on this account).
+    """
+    try:
+        return _fetch_account_resources(api_key)
+    except Exception:
+        # Independent lookups — overlap them on the shared session
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            templates = pool.submit(get_user_templates, api_key)
+            auths = pool.submit(get_registry_auths, api_key)
+        return templates.result(), auths.result()
+
+
 def save_template(api_key, registry_auth_id=None):
     print(f"Creating Template: {TEMPLATE_NAME}...")
-    query = """
-    mutation saveTemplate($input: SaveTemplateInput!) {
-        saveTemplate(input: $input) {
-            id
-            name
-        }
-    }
-    """
     input_vars = {
         "name": TEMPLATE_NAME,
         "imageName": IMAGE_NAME,
         "containerDiskInGb": 20,
         "volumeInGb": 0,
         "dockerArgs": "python3 -u handler/main.py",
-        "env": [
-            {"key": "RUNPOD_DEBUG", "value": "true"},
-            # B2 credentials from RunPod secret manager (not in job payload)
-            {"key": "B2_ENDPOINT", "value": "{{ RUNPOD_SECRET_b2_endpoint }}"},
-            {
-                "key": "B2_ACCESS_KEY_ID",
-                "value": "{{ RUNPOD_SECRET_b2_access_key_id }}",
-            },
-            {
-                "key": "B2_SECRET_ACCESS_KEY",
-                "value": "{{ RUNPOD_SECRET_b2_secret_access_key }}",
-            },
-            {"key": "B2_BUCKET_NAME", "value": "{{ RUNPOD_SECRET_b2_bucket_name }}"},
-            # R2 credentials from RunPod secret manager (not in job payload)
-            {"key": "R2_ENDPOINT", "value": "{{ RUNPOD_SECRET_r2_endpoint }}"},
-            {
-                "key": "R2_ACCESS_KEY_ID",
-                "value": "{{ RUNPOD_SECRET_r2_access_key_id }}",
-            },
-            {
-                "key": "R2_SECRET_ACCESS_KEY",
-                "value": "{{ RUNPOD_SECRET_r2_secret_access_key }}",
-            },
-            {"key": "R2_BUCKET_NAME", "value": "{{ RUNPOD_SECRET_r2_bucket_name }}"},
-            # Feature flags — toggle pipeline steps without a redeploy.
-            # Mezzanine is off until a consumer is wired up; others match
-            # current production behavior. See handler/main.py FEATURES dict.
-            {"key": "ENABLE_MEZZANINE", "value": "false"},
-            {"key": "ENABLE_LOUDNESS_ANALYSIS", "value": "true"},
-            {"key": "ENABLE_WAVEFORM_IMAGE", "value": "true"},
-            {"key": "ENABLE_THUMBNAIL_VARIANTS", "value": "true"},
-            {"key": "ENABLE_VIDEO_PREVIEW", "value": "true"},
-        ],
+        "env": TEMPLATE_ENV,
         "isServerless": True,
     }
 
@@ -123,21 +165,13 @@ def save_template(api_key, registry_auth_id=None):
 
     variables = {"input": input_vars}
 
-    data = run_query(query, variables, api_key)
+    data = run_query(SAVE_TEMPLATE, variables, api_key)
+    invalidate_cache(api_key)
     return data["saveTemplate"]
 
 
 def save_endpoint(api_key, template_id):
     print(f"Creating Endpoint: {ENDPOINT_NAME}...")
-    query = """
-    mutation saveEndpoint($input: EndpointInput!) {
-        saveEndpoint(input: $input) {
-            id
-            name
-            gpuIds
-        }
-    }
-    """
     variables = {
         "input": {
             "name": ENDPOINT_NAME,
@@ -151,7 +185,7 @@ def save_endpoint(api_key, template_id):
             "workersMax": 5,
         }
     }
-    data = run_query(query, variables, api_key)
+    data = run_query(SAVE_ENDPOINT, variables, api_key)
     return data["saveEndpoint"]
 
 
@@ -162,8 +196,9 @@ def main():
         sys.exit(1)
 
     try:
+        templates, auths = get_account_resources(api_key)
+
         # 0. Find Registry Creds (Auto-detect)
-        auths = get_registry_auths(api_key)
         registry_auth_id = None
         for auth in auths:
             # Look for explicit GHCR or just use the first/only one if user only has one
@@ -183,13 +218,12 @@ def main():
             )
 
         # 1. Find or Create Template
-        templates = get_user_templates(api_key)
+        # reversed: if names repeat, the first listed template wins (as before)
+        templates_by_name = {t["name"]: t for t in reversed(templates)}
         template_id = None
-        for t in templates:
-            if t["name"] == TEMPLATE_NAME:
-                template_id = t["id"]
-                print(f"✅ Found existing template: {template_id}")
-                break
+        if TEMPLATE_NAME in templates_by_name:
+            template_id = templates_by_name[TEMPLATE_NAME]["id"]
+            print(f"✅ Found existing template: {template_id}")
 
         if not template_id:
             template = save_template(api_key, registry_auth_id)
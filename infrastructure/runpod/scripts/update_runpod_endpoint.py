@@ -1,95 +1,33 @@
 import os
 import sys
-import requests
-
-
-def get_endpoint_details(url, headers, endpoint_id):
-    """Query all endpoints and find the matching one."""
-    query = """
-    query Endpoints {
-        myself {
-            endpoints {
-                id
-                name
-                templateId
-                gpuIds
-                workersMin
-                workersMax
-            }
-        }
-    }
-    """
 
-    response = requests.post(
-        url,
-        json={"query": query},
-        headers=headers,
-        timeout=30,
-    )
+from _gql import GET_ENDPOINTS_AND_TEMPLATES, SAVE_TEMPLATE, run_query
 
-    if response.status_code != 200:
-        print(f"❌ Failed to query endpoints: {response.status_code} - {response.text}")
-        return None
 
-    data = response.json()
-    if "errors" in data:
-        print(f"❌ GraphQL Errors: {data['errors']}")
+def get_account_resources(api_key):
+    """Fetch endpoints and pod templates together in one GraphQL request."""
+    try:
+        data = run_query(GET_ENDPOINTS_AND_TEMPLATES, api_key=api_key)
+    except Exception as e:
+        print(f"❌ Failed to query endpoints/templates: {e}")
         return None
 
-    endpoints = data.get("data", {}).get("myself", {}).get("endpoints", [])
+    return data.get("myself") or {}
 
-    # Find the matching endpoint
-    for endpoint in endpoints:
-        if endpoint["id"] == endpoint_id:
-            return endpoint
 
-    print(f"❌ Endpoint {endpoint_id} not found in {len(endpoints)} endpoints")
-    return None
+def get_endpoint_details(endpoints_by_id, endpoint_id):
+    """Look up the endpoint in the fetched endpoints, indexed by id."""
+    endpoint = endpoints_by_id.get(endpoint_id)
+    if endpoint is None:
+        print(
+            f"❌ Endpoint {endpoint_id} not found in {len(endpoints_by_id)} endpoints"
+        )
+    return endpoint
 
 
-def update_template(url, headers, template_id, new_image_name):
+def update_template(api_key, templates_by_id, template_id, new_image_name):
     """Update template with new Docker image."""
-    # First get the template details
-    query = """
-    query PodTemplates {
-        myself {
-            podTemplates {
-                id
-                name
-                imageName
-                containerDiskInGb
-                volumeInGb
-                dockerArgs
-                env {
-                    key
-                    value
-                }
-            }
-        }
-    }
-    """
-
-    response = requests.post(
-        url,
-        json={"query": query},
-        headers=headers,
-        timeout=30,
-    )
-
-    if response.status_code != 200:
-        print(f"❌ Failed to query templates: {response.status_code} - {response.text}")
-        return False
-
-    data = response.json()
-    templates = data.get("data", {}).get("myself", {}).get("podTemplates", [])
-
-    # Find the matching template
-    template = None
-    for t in templates:
-        if t["id"] == template_id:
-            template = t
-            break
-
+    template = templates_by_id.get(template_id)
     if not template:
         print(f"❌ Template {template_id} not found")
         return False
@@ -98,17 +36,16 @@ def update_template(url, headers, template_id, new_image_name):
         f"📦 Found template: {template['name']} (current image: {template['imageName']})"
     )
 
-    # Update the template with new image
-    mutation = """
-    mutation saveTemplate($input: SaveTemplateInput!) {
-        saveTemplate(input: $input) {
-            id
-            name
-            imageName
-        }
-    }
-    """
+    # Re-saving an unchanged immutable tag (e.g. a re-run of the same sha-*
+    # deploy) is a no-op that would only churn workers. A mutable tag like
+    # :latest is always re-saved so workers pick up the newly pushed image.
+    if template["imageName"] == new_image_name and not new_image_name.endswith(
+        ":latest"
+    ):
+        print(f"✅ Template already uses {new_image_name}, nothing to update")
+        return True
 
+    # Update the template with new image
     # Convert env list to the format expected by the API
     env_vars = template.get("env") or []
 
@@ -125,23 +62,13 @@ def update_template(url, headers, template_id, new_image_name):
         }
     }
 
-    response = requests.post(
-        url,
-        json={"query": mutation, "variables": variables},
-        headers=headers,
-        timeout=30,
-    )
-
-    if response.status_code != 200:
-        print(f"❌ API Request failed: {response.status_code} - {response.text}")
-        return False
-
-    data = response.json()
-    if "errors" in data:
-        print(f"❌ GraphQL Errors: {data['errors']}")
+    try:
+        data = run_query(SAVE_TEMPLATE, variables, api_key)
+    except Exception as e:
+        print(f"❌ API Request failed: {e}")
         return False
 
-    result = data.get("data", {}).get("saveTemplate")
+    result = data.get("saveTemplate")
     print(f"✅ Updated template {result['id']} to image: {result['imageName']}")
     return True
 
@@ -161,11 +88,15 @@ def update_endpoint():
     full_image_name = f"{docker_image_base.lower()}:{image_tag}"
     print(f"🚀 Updating RunPod Endpoint {endpoint_id} to use image: {full_image_name}")
 
-    url = "https://api.runpod.io/graphql"
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    # Get current endpoint and template details in one round trip
+    resources = get_account_resources(api_key)
+    if resources is None:
+        sys.exit(1)
+
+    endpoints_by_id = {e["id"]: e for e in resources.get("endpoints") or []}
+    templates_by_id = {t["id"]: t for t in resources.get("podTemplates") or []}
 
-    # Get current endpoint details
-    endpoint = get_endpoint_details(url, headers, endpoint_id)
+    endpoint = get_endpoint_details(endpoints_by_id, endpoint_id)
     if not endpoint:
         print(f"❌ Could not find endpoint {endpoint_id}")
         sys.exit(1)
@@ -173,7 +104,9 @@ def update_endpoint():
     print(f"📍 Found endpoint: {endpoint['name']} (template: {endpoint['templateId']})")
 
     # Update the template associated with this endpoint
-    if not update_template(url, headers, endpoint["templateId"], full_image_name):
+    if not update_template(
+        api_key, templates_by_id, endpoint["templateId"], full_image_name
+    ):
         sys.exit(1)
 
     print(f"✅ Endpoint {endpoint_id} will now use the updated template")
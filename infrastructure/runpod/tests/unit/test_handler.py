@@ -1,6 +1,12 @@
+import copy
+import hashlib
+import hmac
 import os
 import json
+import subprocess
 import pytest
+from collections import Counter
+from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
 # Ensure handler is in python path
@@ -8,8 +14,12 @@ import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
-# Mock runpod before importing handler to prevent side-effects (like auto-starting worker)
-sys.modules["runpod"] = MagicMock()
+# Stub runpod before importing handler to prevent side-effects (like auto-starting
+# worker). The handler only touches runpod.serverless.start, so a plain namespace
+# is enough — no MagicMock attribute auto-creation.
+sys.modules["runpod"] = SimpleNamespace(
+    serverless=SimpleNamespace(start=lambda *args, **kwargs: None)
+)
 from handler import main as handler_module
 
 # =============================================================================
@@ -90,11 +100,20 @@ class TestValidatePathComponent:
                 handler_module.validate_path_component(attempt, "testPath")
 
 
+# The boto3 S3 client methods the handler calls. The mock client allows only
+# these, so a call to anything else fails loudly instead of returning a mock.
+_S3_CLIENT_METHODS = [
+    "delete_object",
+    "download_file",
+    "generate_presigned_url",
+    "upload_file",
+]
+
+
 @pytest.fixture
 def mock_s3_client():
     with patch("handler.main.create_s3_client") as mock:
-        client = MagicMock()
-        mock.return_value = client
+        mock.return_value = MagicMock(spec_set=_S3_CLIENT_METHODS)
         yield mock
 
 
@@ -124,18 +143,108 @@ def mock_download_file():
         yield mock
 
 
-@pytest.fixture
-def mock_subprocess():
-    with patch("subprocess.run") as mock:
-        # Default mock response for success
-        mock.return_value.returncode = 0
-        mock.return_value.stdout = ""
-        yield mock
+# ffprobe outputs, serialized once at import
+_PROBE_VIDEO_JSON = json.dumps(
+    {
+        "format": {"duration": "100.0"},
+        "streams": [{"codec_type": "video", "width": 1920, "height": 1080}],
+    }
+)
+_PROBE_AUDIO_JSON = json.dumps(
+    {"format": {"duration": "300.0"}, "streams": [{"codec_type": "audio"}]}
+)
+_PROBE_720P_JSON = json.dumps(
+    {
+        "format": {"duration": "60.0"},
+        "streams": [{"codec_type": "video", "width": 1280, "height": 720}],
+    }
+)
+
+# Prebuilt subprocess results, shared by every call that returns them. The
+# handler only reads returncode/stdout/stderr.
+_OK_RESULT = subprocess.CompletedProcess([], 0, stdout="", stderr=b"")
+_PROBE_VIDEO_RESULT = subprocess.CompletedProcess(
+    [], 0, stdout=_PROBE_VIDEO_JSON, stderr=b""
+)
+_PROBE_AUDIO_RESULT = subprocess.CompletedProcess(
+    [], 0, stdout=_PROBE_AUDIO_JSON, stderr=b""
+)
+_PROBE_720P_RESULT = subprocess.CompletedProcess(
+    [], 0, stdout=_PROBE_720P_JSON, stderr=b""
+)
+# Loudness analysis prints its JSON summary to stderr (captured as bytes)
+_LOUDNORM_RESULT = subprocess.CompletedProcess(
+    [],
+    0,
+    stdout="",
+    stderr=b'{"input_i": "-14.0", "input_tp": "-0.5", "input_lra": "5.0"}',
+)
+
+
+def _returns(result):
+    """Dispatcher route that always answers with `result`."""
+    return lambda cmd, **kwargs: result
+
+
+class SubprocessDispatcher(dict):
+    """Stand-in for subprocess.run that routes on the program name (cmd[0]).
+
+    Tests register `dispatcher["ffprobe"] = fn(cmd, **kwargs)`; unregistered
+    programs succeed with no output. Every argv is recorded in `calls`, and
+    `runs` counts invocations per program.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.runs = Counter()
+
+    def __call__(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        self.runs[cmd[0]] += 1
+        route = self.get(cmd[0])
+        return _OK_RESULT if route is None else route(cmd, **kwargs)
+
+    def reset(self):
+        self.clear()
+        self.calls.clear()
+        self.runs.clear()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def subprocess_dispatcher():
+    """Patch subprocess.run once for the whole module."""
+    dispatcher = SubprocessDispatcher()
+    with patch("subprocess.run", new=dispatcher):
+        yield dispatcher
+
+
+@pytest.fixture(autouse=True)
+def mock_subprocess(subprocess_dispatcher):
+    """Per-test view of the dispatcher, cleared so routes never leak."""
+    subprocess_dispatcher.reset()
+    yield subprocess_dispatcher
+
+
+@pytest.fixture(autouse=True)
+def clear_worker_caches():
+    """Reset the handler's per-worker caches so no test sees another's result."""
+    caches = (
+        handler_module.check_gpu_available.cache_clear,
+        handler_module.gpu_scaling_available.cache_clear,
+        handler_module._S3_CLIENTS.clear,
+    )
+    for clear in caches:
+        clear()
+    yield
+    for clear in caches:
+        clear()
 
 
 @pytest.fixture
 def mock_requests():
-    with patch("requests.post") as mock:
+    # Webhooks go through the module's pooled session, not requests.post
+    with patch.object(handler_module._HTTP_SESSION, "post") as mock:
         mock.return_value.status_code = 200
         yield mock
 
@@ -146,42 +255,59 @@ def mock_check_gpu():
         yield mock
 
 
-@pytest.fixture
+# Environment variables required by handler (B2, R2, ASSETS, webhook)
+_STORAGE_ENV = {
+    # Webhook HMAC signing secret (read from env, not job payload)
+    "WEBHOOK_SECRET": "secret-123",
+    # B2 (Backblaze) for mezzanine archival
+    "B2_ENDPOINT": "https://b2.example.com",
+    "B2_ACCESS_KEY_ID": "test-key",
+    "B2_SECRET_ACCESS_KEY": "test-secret",
+    "B2_BUCKET_NAME": "archive-bucket",
+    # R2 for HLS streaming outputs
+    "R2_ENDPOINT": "https://r2.example.com",
+    "R2_ACCESS_KEY_ID": "r2-key",
+    "R2_SECRET_ACCESS_KEY": "r2-secret",
+    "R2_BUCKET_NAME": "media-bucket",
+    # Assets bucket uses shared R2 credentials
+    "ASSETS_BUCKET_NAME": "assets-bucket",
+}
+
+
+@pytest.fixture(scope="session")
 def mock_storage_env():
-    """Set environment variables required by handler (B2, R2, ASSETS, webhook)."""
-    with patch.dict(
-        os.environ,
-        {
-            # Webhook HMAC signing secret (read from env, not job payload)
-            "WEBHOOK_SECRET": "secret-123",
-            # B2 (Backblaze) for mezzanine archival
-            "B2_ENDPOINT": "https://b2.example.com",
-            "B2_ACCESS_KEY_ID": "test-key",
-            "B2_SECRET_ACCESS_KEY": "test-secret",
-            "B2_BUCKET_NAME": "archive-bucket",
-            # R2 for HLS streaming outputs
-            "R2_ENDPOINT": "https://r2.example.com",
-            "R2_ACCESS_KEY_ID": "r2-key",
-            "R2_SECRET_ACCESS_KEY": "r2-secret",
-            "R2_BUCKET_NAME": "media-bucket",
-            # Assets bucket uses shared R2 credentials
-            "ASSETS_BUCKET_NAME": "assets-bucket",
-        },
-    ):
+    """Install _STORAGE_ENV once per session — no test changes these variables.
+
+    Only these keys are saved and restored, rather than patch.dict's copy of
+    the whole environment.
+    """
+    saved = {key: os.environ.get(key) for key in _STORAGE_ENV}
+    os.environ.update(_STORAGE_ENV)
+    try:
         yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+# Job input payload - credentials come from environment, not payload
+_BASE_JOB_INPUT = {
+    "mediaId": "test-media-123",
+    "creatorId": "user-123",
+    "type": "video",
+    "inputKey": "user-123/originals/test-media-123/video.mp4",
+    "webhookUrl": "https://api.example.com/webhook",
+    "webhookSecret": "secret-123",
+}
 
 
 @pytest.fixture
 def basic_job_input():
-    """Job input payload - credentials come from environment, not payload."""
-    return {
-        "mediaId": "test-media-123",
-        "creatorId": "user-123",
-        "type": "video",
-        "inputKey": "user-123/originals/test-media-123/video.mp4",
-        "webhookUrl": "https://api.example.com/webhook",
-        "webhookSecret": "secret-123",
-    }
+    """Fresh copy per test, so tests may mutate it (e.g. type = "audio")."""
+    return copy.deepcopy(_BASE_JOB_INPUT)
 
 
 class TestHlsSingleFileCommands:
@@ -197,20 +323,136 @@ class TestHlsSingleFileCommands:
         assert set(handler_module.HLS_VARIANTS.keys()) == {"720p", "480p"}
 
     @pytest.mark.parametrize("use_gpu", [True, False])
-    def test_variant_cmd_is_single_file(self, use_gpu):
-        cmd = handler_module._build_hls_variant_cmd(
+    def test_ladder_cmd_is_single_file(self, use_gpu):
+        cmd = handler_module._build_hls_ladder_cmd(
             "in.mp4",
-            "/out/720p",
-            "/out/720p/index.m3u8",
-            handler_module.HLS_VARIANTS["720p"],
+            "/out",
+            list(handler_module.HLS_VARIANTS.items()),
             use_gpu=use_gpu,
         )
-        # single_file flag present and immediately follows it with the value
-        assert cmd[cmd.index("-hls_flags") + 1] == "single_file"
-        # exactly one .ts file (no %03d sequence template)
-        seg = cmd[cmd.index("-hls_segment_filename") + 1]
-        assert seg.endswith("stream.ts")
-        assert "%03d" not in seg
+        flag_positions = [i for i, arg in enumerate(cmd) if arg == "-hls_flags"]
+        seg_positions = [
+            i for i, arg in enumerate(cmd) if arg == "-hls_segment_filename"
+        ]
+        assert len(flag_positions) == len(handler_module.HLS_VARIANTS)
+        for i in flag_positions:
+            # single_file flag present and immediately follows it with the value
+            assert cmd[i + 1] == "single_file"
+        for i in seg_positions:
+            # exactly one .ts file per variant (no %03d sequence template)
+            assert cmd[i + 1].endswith("stream.ts")
+            assert "%03d" not in cmd[i + 1]
+
+    @pytest.mark.parametrize("use_gpu", [True, False])
+    def test_ladder_cmd_decodes_source_once(self, use_gpu):
+        variants = list(handler_module.HLS_VARIANTS.items())
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4", "/out", variants, use_gpu=use_gpu
+        )
+        # One input, read once by the filter graph, one playlist output per variant
+        assert cmd.count("-i") == 1
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert graph.count("[0:v]") == 1
+        for name, _ in variants:
+            assert f"/out/{name}/index.m3u8" in cmd
+
+    def test_ladder_cascades_lower_rungs_from_higher(self):
+        # Listed smallest-first to prove ordering comes from height, not dict order
+        variants = [
+            ("480p", handler_module.HLS_VARIANTS["480p"]),
+            ("720p", handler_module.HLS_VARIANTS["720p"]),
+        ]
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4", "/out", variants, use_gpu=False
+        )
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert graph == "[0:v]scale=-2:720,split=2[v1][c1];[c1]scale=-2:480[v0]"
+        # Output blocks still follow the variant order they were given in
+        maps = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-map"]
+        assert maps[0::2] == ["[v0]", "[v1]"]
+
+    def test_gpu_ladder_keeps_frames_on_device(self):
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4",
+            "/out",
+            list(handler_module.HLS_VARIANTS.items()),
+            use_gpu=True,
+            device_frames=True,
+        )
+        assert cmd[cmd.index("-hwaccel_output_format") + 1] == "cuda"
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert "scale_npp=-2:720" in graph
+        assert "scale=-2" not in graph
+
+    def test_gpu_ladder_without_device_frames_scales_on_host(self):
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4", "/out", list(handler_module.HLS_VARIANTS.items()), use_gpu=True
+        )
+        assert cmd[cmd.index("-hwaccel") + 1] == "cuda"
+        assert "-hwaccel_output_format" not in cmd
+        assert "scale_npp" not in cmd[cmd.index("-filter_complex") + 1]
+        assert cmd[cmd.index("-c:v") + 1] == "h264_nvenc"
+
+    def test_cpu_ladder_uses_software_scale(self):
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4", "/out", list(handler_module.HLS_VARIANTS.items()), use_gpu=False
+        )
+        assert "-hwaccel_output_format" not in cmd
+        assert "scale_npp" not in cmd[cmd.index("-filter_complex") + 1]
+
+    def test_gpu_encodes_use_vod_quality_preset(self):
+        ladder = handler_module._build_hls_ladder_cmd(
+            "in.mp4", "/out", list(handler_module.HLS_VARIANTS.items()), use_gpu=True
+        )
+        mezzanine = handler_module._build_mezzanine_cmd(
+            "in.mp4", "mezz.mp4", use_gpu=True
+        )
+        for cmd in (ladder, mezzanine):
+            assert cmd[cmd.index("-preset") + 1] == "p7"
+            assert cmd[cmd.index("-rc") + 1] == "vbr"
+        assert ladder[ladder.index("-cq") + 1] == "23"
+        assert mezzanine[mezzanine.index("-cq") + 1] == "18"
+
+    def test_ladder_keyframes_align_to_segments(self):
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4",
+            "/out",
+            list(handler_module.HLS_VARIANTS.items()),
+            use_gpu=False,
+            fps=30000 / 1001,
+        )
+        # One fixed 6s GOP per segment on every rung
+        assert cmd.count("-g") == len(handler_module.HLS_VARIANTS)
+        assert cmd[cmd.index("-g") + 1] == "180"
+        assert cmd[cmd.index("-sc_threshold") + 1] == "0"
+        assert "expr:gte(t,n_forced*6)" in cmd
+
+    @pytest.mark.parametrize("use_gpu", [True, False])
+    def test_mezzanine_is_faststart_with_2s_gop(self, use_gpu):
+        cmd = handler_module._build_mezzanine_cmd(
+            "in.mp4", "mezz.mp4", use_gpu=use_gpu, fps=25.0
+        )
+        assert cmd[cmd.index("-movflags") + 1] == "+faststart"
+        assert cmd[cmd.index("-g") + 1] == "50"
+        assert cmd[-1] == "mezz.mp4"
+
+    def test_ladder_with_mezzanine_decodes_once(self):
+        cmd = handler_module._build_hls_ladder_cmd(
+            "in.mp4",
+            "/out",
+            list(handler_module.HLS_VARIANTS.items()),
+            use_gpu=False,
+            fps=25.0,
+            mezzanine_path="mezz.mp4",
+        )
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert cmd.count("-i") == 1
+        assert graph.startswith("[0:v]split=2[mz][src];[src]scale=")
+        # Mezzanine keeps its own archival encode and 2s GOP
+        mezz = cmd[cmd.index("[mz]") - 1 : cmd.index("mezz.mp4") + 1]
+        assert mezz[mezz.index("-crf") + 1] == "18"
+        assert mezz[mezz.index("-g") + 1] == "50"
+        assert cmd.count("-f") == len(handler_module.HLS_VARIANTS)
 
     @pytest.mark.parametrize("use_gpu", [True, False])
     def test_preview_cmd_is_single_file(self, use_gpu):
@@ -223,6 +465,316 @@ class TestHlsSingleFileCommands:
         assert "%03d" not in seg
 
 
+@pytest.mark.parametrize(
+    "r_frame_rate, expected",
+    [("30000/1001", 30000 / 1001), ("25/1", 25.0), ("0/0", None), ("N/A", None)],
+)
+def test_get_frame_rate(r_frame_rate, expected):
+    probe = {
+        "streams": [
+            {"codec_type": "audio", "r_frame_rate": "0/0"},
+            {"codec_type": "video", "r_frame_rate": r_frame_rate},
+        ]
+    }
+    assert handler_module.get_frame_rate(probe) == expected
+
+
+class TestInputArgs:
+    """Remote sources get reconnect options; local paths are passed as-is."""
+
+    def test_local_path(self):
+        assert handler_module._input_args("/tmp/in.mp4") == ["-i", "/tmp/in.mp4"]
+
+    def test_presigned_url_reconnects(self):
+        url = "https://r2.example.com/bucket/key?X-Amz-Signature=abc"
+        args = handler_module._input_args(url)
+        assert args[-2:] == ["-i", url]
+        assert args[args.index("-reconnect") + 1] == "1"
+        assert "-reconnect_streamed" in args
+
+
+class TestRunFfmpeg:
+    """run_ffmpeg quiets ffmpeg and only keeps the output it needs."""
+
+    def test_ffmpeg_is_quiet_and_stdout_discarded(self):
+        with patch("subprocess.run") as mock_run:
+            handler_module.run_ffmpeg(["ffmpeg", "-y", "-i", "in.mp4", "out.mp4"])
+        cmd = mock_run.call_args[0][0]
+        assert cmd[:5] == ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error"]
+        assert cmd[5:] == ["-y", "-i", "in.mp4", "out.mp4"]
+        assert mock_run.call_args[1]["stdout"] is subprocess.DEVNULL
+
+    def test_ffprobe_stdout_captured_and_args_untouched(self):
+        with patch("subprocess.run") as mock_run:
+            handler_module.run_ffmpeg(["ffprobe", "in.mp4"], capture_stdout=True)
+        assert mock_run.call_args[0][0] == ["ffprobe", "in.mp4"]
+        assert mock_run.call_args[1]["stdout"] is subprocess.PIPE
+
+    def test_failure_keeps_stderr_excerpt(self):
+        error = subprocess.CalledProcessError(1, ["ffmpeg"], stderr="x" * 3000 + "boom")
+        with patch("subprocess.run", side_effect=error):
+            with pytest.raises(RuntimeError, match="boom$"):
+                handler_module.run_ffmpeg(["ffmpeg"], description="HLS")
+
+    def test_failure_redacts_presigned_url(self):
+        url = "https://r2.example.com/b/in.mp4?X-Amz-Credential=AK&X-Amz-Signature=s1g"
+        error = subprocess.CalledProcessError(1, ["ffmpeg"], stderr=f"{url}: 403")
+        with patch("subprocess.run", side_effect=error):
+            with pytest.raises(RuntimeError) as excinfo:
+                handler_module.run_ffmpeg(["ffmpeg", "-i", url])
+        message = str(excinfo.value)
+        assert "https://r2.example.com/b/in.mp4?<redacted>" in message
+        assert "X-Amz" not in message and "s1g" not in message
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        (" ... scale_npp         V->V       NVIDIA Performance Primitives\n", True),
+        (" ... scale             V->V       Scale the input video size\n", False),
+    ],
+)
+def test_gpu_scaling_available(filters, expected):
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.stdout = filters
+        assert handler_module.gpu_scaling_available() is expected
+
+
+class TestRunEncode:
+    """GPU encodes fall back CUDA frames → host-side NVENC → libx264."""
+
+    def _run(self, scaling, failures):
+        attempts = []
+
+        def run(cmd, **kwargs):
+            attempts.append(cmd)
+            if len(attempts) <= failures:
+                raise RuntimeError("boom")
+
+        with (
+            patch("handler.main.gpu_scaling_available", return_value=scaling),
+            patch("handler.main.run_ffmpeg", side_effect=run),
+        ):
+            handler_module._run_encode(
+                lambda gpu, device_frames: [gpu, device_frames],
+                use_gpu=True,
+                timeout=1,
+                description="HLS",
+            )
+        return attempts
+
+    def test_tries_every_path_in_order(self):
+        attempts = self._run(scaling=True, failures=2)
+        assert attempts == [[True, True], [True, False], [False, False]]
+
+    def test_skips_device_frames_without_scale_npp(self):
+        assert self._run(scaling=False, failures=0) == [[True, False]]
+
+
+def test_gpu_check_runs_once_per_worker():
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        assert handler_module.check_gpu_available() is True
+        assert handler_module.check_gpu_available() is True
+    assert mock_run.call_count == 1
+
+
+def test_s3_client_reused_across_jobs():
+    with patch("boto3.client", side_effect=lambda *a, **kw: MagicMock()) as mock_client:
+        first = handler_module.create_s3_client("https://r2", "key", "secret")
+        again = handler_module.create_s3_client("https://r2", "key", "secret")
+        other = handler_module.create_s3_client("https://b2", "key", "secret")
+        rotated = handler_module.create_s3_client("https://r2", "key", "secret2")
+    assert first is again
+    assert other is not first and rotated is not first
+    assert mock_client.call_count == 3
+    # The cache holds a fingerprint of the credentials, never the secrets
+    assert "secret" not in repr(list(handler_module._S3_CLIENTS))
+    # Pool holds every concurrent part request of a directory upload
+    pool = mock_client.call_args.kwargs["config"].max_pool_connections
+    assert pool >= (
+        handler_module.UPLOAD_WORKERS * handler_module.TRANSFER_CONFIG.max_concurrency
+    )
+
+
+def test_sign_payload_matches_server_format():
+    """Signature covers 'timestamp.body' over the exact bytes that are sent."""
+    body = handler_module._encode_payload({"jobId": "j1", "status": "completed"})
+    assert body == b'{"jobId":"j1","status":"completed"}'
+
+    signature = handler_module.sign_payload(body, b"secret-123", "1700000000")
+    expected = hmac.new(
+        b"secret-123", b"1700000000." + body, hashlib.sha256
+    ).hexdigest()
+    assert signature == expected
+
+
+def test_thumbnail_variants_share_one_decode():
+    with patch("handler.main.run_ffmpeg") as mock_run:
+        variants = handler_module.extract_thumbnail_variants("in.mp4", "/w", 100)
+
+    assert mock_run.call_count == 1
+    cmd = mock_run.call_args[0][0]
+    assert cmd[cmd.index("-ss") + 1] == "10"
+    assert cmd.count("-i") == 1
+    assert cmd[cmd.index("-filter_complex") + 1].startswith("[0:v]split=3")
+    assert [a for a in cmd if a.endswith(".webp")] == list(variants.values())
+    assert list(variants) == ["sm", "md", "lg"]
+
+
+class TestGenerateWaveform:
+    """Waveform JSON + PNG are rendered from one decode of the audio."""
+
+    def test_png_and_json_rendered_from_dat(self):
+        with patch("handler.main.run_ffmpeg") as mock_run:
+            handler_module.generate_waveform(
+                "in.mp3", "/w/waveform.json", "/w/waveform.png", duration=30
+            )
+        cmds = [c[0][0] for c in mock_run.call_args_list]
+        inputs = [cmd[cmd.index("-i") + 1] for cmd in cmds]
+        assert inputs == ["in.mp3", "/w/waveform.dat", "/w/waveform.dat"]
+        # 1800px over 30s needs 60 points/s in the intermediate
+        assert cmds[0][cmds[0].index("--pixels-per-second") + 1] == "60"
+        assert cmds[1][cmds[1].index("--pixels-per-second") + 1] == "10"
+        # The PNG spans the whole track at the .dat's resolution or coarser
+        assert cmds[2][cmds[2].index("--zoom") + 1] == "auto"
+
+    def test_json_only_decodes_source_directly(self):
+        with patch("handler.main.run_ffmpeg") as mock_run:
+            handler_module.generate_waveform("in.mp3", "/w/waveform.json", None)
+        assert mock_run.call_count == 1
+        cmd = mock_run.call_args[0][0]
+        assert cmd[cmd.index("-i") + 1] == "in.mp3"
+
+
+class TestPreviewFromVariant:
+    """The preview is cut from the 720p rung instead of being re-encoded."""
+
+    def _make_720p_rung(self, tmp_path, segment_count=20):
+        rung = tmp_path / "720p"
+        rung.mkdir()
+        lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-TARGETDURATION:6"]
+        data = b""
+        for i in range(segment_count):
+            chunk = bytes([i]) * 100
+            lines += ["#EXTINF:6.000000,", f"#EXT-X-BYTERANGE:100@{len(data)}"]
+            lines.append("stream.ts")
+            data += chunk
+        lines.append("#EXT-X-ENDLIST")
+        (rung / "index.m3u8").write_text("\n".join(lines) + "\n")
+        (rung / "stream.ts").write_bytes(data)
+
+    def test_preview_copies_only_window_segments(self, tmp_path):
+        self._make_720p_rung(tmp_path)
+        with patch("handler.main.run_ffmpeg") as mock_run:
+            # duration 120s → window starts at 12s: segments 2..6 (30s)
+            handler_module.create_preview("in.mp4", str(tmp_path), 120, False)
+
+        mock_run.assert_not_called()
+        preview = tmp_path / "preview"
+        assert (preview / "stream.ts").read_bytes() == b"".join(
+            bytes([i]) * 100 for i in range(2, 7)
+        )
+        playlist = (preview / "preview.m3u8").read_text()
+        assert playlist.count("#EXTINF") == 5
+        assert "#EXT-X-BYTERANGE:100@0" in playlist
+        assert "#EXT-X-BYTERANGE:100@400" in playlist
+        assert playlist.rstrip().endswith("#EXT-X-ENDLIST")
+
+    def test_preview_encodes_without_720p_rung(self, tmp_path):
+        with patch("handler.main.run_ffmpeg") as mock_run:
+            handler_module.create_preview("in.mp4", str(tmp_path), 120, False)
+        assert mock_run.call_count == 1
+
+
+class TestLoudnormFilter:
+    """Second-pass loudnorm is only used with real first-pass measurements."""
+
+    def test_measured_values_enable_linear_second_pass(self):
+        af = handler_module._loudnorm_filter(
+            {
+                "input_i": -20.5,
+                "input_tp": -3.1,
+                "input_lra": 6.0,
+                "input_thresh": -31.2,
+                "target_offset": 0.4,
+            }
+        )
+        assert "measured_I=-20.5" in af
+        assert "measured_thresh=-31.2" in af
+        assert "offset=0.4" in af
+        assert "linear=true" in af
+
+    @pytest.mark.parametrize(
+        "loudness", [None, {"input_i": -16, "input_tp": -1, "input_lra": 7}]
+    )
+    def test_missing_measurements_fall_back_to_one_pass(self, loudness):
+        af = handler_module._loudnorm_filter(loudness)
+        assert af == "loudnorm=I=-16:TP=-1.5:LRA=11"
+
+
+class TestUploadDirectoryTracked:
+    """Parallel HLS upload keeps failure cleanup intact."""
+
+    @staticmethod
+    def _make_hls_dir(root):
+        (root / "720p").mkdir()
+        (root / "master.m3u8").write_text("#EXTM3U\n")
+        (root / "720p" / "index.m3u8").write_text("#EXTM3U\n")
+        (root / "720p" / "stream.ts").write_bytes(b"\x47" * 188)
+
+    def test_uploads_every_file_with_content_type(self, tmp_path):
+        self._make_hls_dir(tmp_path)
+        client = MagicMock()
+
+        uploaded = handler_module.upload_directory_tracked(
+            client, "bucket", "c/hls/m/", str(tmp_path)
+        )
+
+        keys = sorted(key for _, _, key in uploaded)
+        assert keys == [
+            "c/hls/m/720p/index.m3u8",
+            "c/hls/m/720p/stream.ts",
+            "c/hls/m/master.m3u8",
+        ]
+        content_types = {
+            c.args[2]: c.kwargs["ExtraArgs"]["ContentType"]
+            for c in client.upload_file.call_args_list
+        }
+        assert content_types["c/hls/m/720p/stream.ts"] == "video/MP2T"
+        assert content_types["c/hls/m/master.m3u8"] == "application/vnd.apple.mpegurl"
+
+    def test_failure_cleans_up_successful_uploads(self, tmp_path):
+        self._make_hls_dir(tmp_path)
+        client = MagicMock()
+
+        def upload(local_path, bucket, key, **kwargs):
+            if key.endswith("stream.ts"):
+                raise RuntimeError("network down")
+
+        client.upload_file.side_effect = upload
+
+        with pytest.raises(RuntimeError, match="network down"):
+            handler_module.upload_directory_tracked(
+                client, "bucket", "c/hls/m/", str(tmp_path)
+            )
+
+        deleted = sorted(c.kwargs["Key"] for c in client.delete_object.call_args_list)
+        assert deleted == ["c/hls/m/720p/index.m3u8", "c/hls/m/master.m3u8"]
+
+
+def test_work_dir_removed_in_background(tmp_path):
+    work_dir = tmp_path / "transcoding_x"
+    (work_dir / "hls").mkdir(parents=True)
+    (work_dir / "hls" / "stream.ts").write_bytes(b"0" * 1024)
+
+    handler_module._remove_work_dir(str(work_dir))
+    handler_module._join_cleanup_threads()
+
+    assert not work_dir.exists()
+    assert not handler_module._CLEANUP_THREADS
+
+
 def test_handler_video_flow_cpu(
     mock_s3_client,
     mock_download_file,
@@ -236,64 +788,186 @@ def test_handler_video_flow_cpu(
 ):
     """Test full video transcoding flow in CPU mode (mocked)."""
 
-    # Mock probe response
-    probe_data = json.dumps(
-        {
-            "format": {"duration": "100.0"},
-            "streams": [{"codec_type": "video", "width": 1920, "height": 1080}],
-        }
-    )
+    # Mock ffmpeg/ffprobe calls. The dispatcher has already routed on cmd[0];
+    # the loudness analysis is the only pass that writes to the null muxer.
+    def ffmpeg(cmd, **kwargs):
+        return _LOUDNORM_RESULT if cmd[-3:] == ["-f", "null", "-"] else _OK_RESULT
 
-    # Mock ffmpeg/ffprobe calls
-    def subprocess_side_effect(cmd, **kwargs):
-        cmd_str = " ".join(cmd)
-        mock_res = MagicMock()
-        mock_res.returncode = 0
-        mock_res.stdout = ""
-        mock_res.stderr = ""  # Important: Must be string, not Mock
-
-        if "ffprobe" in cmd:
-            mock_res.stdout = probe_data
-        elif "loudnorm" in cmd and "-f null" in cmd_str:
-            # Mock loudness analysis stderr output
-            mock_res.stderr = (
-                '{"input_i": "-14.0", "input_tp": "-0.5", "input_lra": "5.0"}'
-            )
+    mock_subprocess["ffprobe"] = _returns(_PROBE_VIDEO_RESULT)
+    mock_subprocess["ffmpeg"] = ffmpeg
+
+    # Execute handler
+    result = handler_module.handler({"input": basic_job_input})
+
+    # Verifications
+    assert result["status"] == "success"
+    assert result["mediaId"] == "test-media-123"
+
+    # Check S3 client creation (R2, B2, and ASSETS)
+    assert mock_s3_client.call_count >= 3
+
+    # Check steps
+    # 1. Download
+    mock_download_file.assert_called_once()
+
+    # 2. Transcode Mezzanine (uploaded to B2)
+    # 3. Transcode HLS (uploaded to R2)
+    # 4. Upload HLS directory
+    mock_upload_directory_tracked.assert_called()
+
+    # 5. Webhook sent — progress webhooks fire during the run, so the final
+    # POST is the completion webhook.
+    assert mock_requests.called
+    call_args = mock_requests.call_args
+    assert call_args[0][0] == basic_job_input["webhookUrl"]
 
-        return mock_res
+    # Verify signature header
+    headers = call_args[1]["headers"]
+    assert "X-Runpod-Signature" in headers
 
-    mock_subprocess.side_effect = subprocess_side_effect
+    # Loudness measured by the analysis pass reaches the completion payload
+    output = json.loads(call_args[1]["data"])["output"]
+    assert output["loudnessIntegrated"] == -1400
 
-    # Mock os.path.getsize for thumbnail size logging
-    with patch("os.path.getsize", return_value=5000):
-        # Execute handler
+
+def test_handler_streams_video_input(
+    mock_s3_client,
+    mock_download_file,
+    mock_upload_file,
+    mock_upload_directory_tracked,
+    mock_subprocess,
+    mock_requests,
+    mock_check_gpu,
+    mock_storage_env,
+    basic_job_input,
+):
+    """With stream_input enabled, video is read from a presigned URL, not downloaded."""
+    presigned = "https://r2.example.com/media-bucket/video.mp4?X-Amz-Signature=abc"
+    mock_s3_client.return_value.generate_presigned_url.return_value = presigned
+
+    mock_subprocess["ffprobe"] = _returns(_PROBE_VIDEO_RESULT)
+
+    with patch.dict(handler_module.FEATURES, {"stream_input": True}):
         result = handler_module.handler({"input": basic_job_input})
 
-        # Verifications
-        assert result["status"] == "success"
-        assert result["mediaId"] == "test-media-123"
+    assert result["status"] == "success"
+    mock_download_file.assert_not_called()
+    ffmpeg_inputs = [
+        cmd[cmd.index("-i") + 1]
+        for cmd in mock_subprocess.calls
+        if cmd[0] in ("ffmpeg", "ffprobe") and "-i" in cmd
+    ]
+    assert ffmpeg_inputs and all(i == presigned for i in ffmpeg_inputs)
+    expiry = mock_s3_client.return_value.generate_presigned_url.call_args[1]
+    assert expiry["ExpiresIn"] > 3 * handler_module.ENCODE_TIMEOUT
+
+
+def test_handler_mezzanine_in_ladder_pass(
+    mock_s3_client,
+    mock_download_file,
+    mock_upload_file,
+    mock_upload_directory_tracked,
+    mock_subprocess,
+    mock_requests,
+    mock_check_gpu,
+    mock_storage_env,
+    basic_job_input,
+):
+    """The mezzanine step is reported, then encoded by the ladder's own pass."""
+    timeouts = {}
+
+    def ffmpeg(cmd, **kwargs):
+        if "mezzanine.mp4" in " ".join(cmd):
+            timeouts[cmd[-1]] = kwargs["timeout"]
+        return _OK_RESULT
+
+    mock_subprocess["ffprobe"] = _returns(_PROBE_VIDEO_RESULT)
+    mock_subprocess["ffmpeg"] = ffmpeg
+
+    with patch.dict(
+        handler_module.FEATURES, {"mezzanine": True, "loudness_analysis": False}
+    ):
+        result = handler_module.handler({"input": basic_job_input})
+
+    assert result["status"] == "success"
+    steps = [json.loads(c[1]["data"]).get("step") for c in mock_requests.call_args_list]
+    assert steps.index("mezzanine") < steps.index("encoding_variants")
+    # One pass writes mezzanine and ladder, with both encodes' time budget
+    assert list(timeouts.values()) == [2 * handler_module.ENCODE_TIMEOUT]
+    uploaded = [c[0][2] for c in mock_upload_file.call_args_list]
+    assert any(key.endswith("/mezzanine.mp4") for key in uploaded)
+
+
+@pytest.mark.parametrize(
+    "probe_error",
+    [
+        subprocess.TimeoutExpired(["ffprobe"], 30),
+        subprocess.CompletedProcess(["ffprobe"], 0, stdout='{"format": '),
+    ],
+    ids=["timeout", "truncated-json"],
+)
+def test_handler_stream_probe_failure_downloads(
+    mock_s3_client,
+    mock_download_file,
+    mock_upload_file,
+    mock_upload_directory_tracked,
+    mock_subprocess,
+    mock_requests,
+    mock_check_gpu,
+    mock_storage_env,
+    basic_job_input,
+    probe_error,
+):
+    """Any failure probing the presigned URL falls back to downloading."""
+    mock_s3_client.return_value.generate_presigned_url.return_value = (
+        "https://r2.example.com/media-bucket/video.mp4?X-Amz-Signature=abc"
+    )
+
+    def probe(cmd, **kwargs):
+        if not cmd[-1].startswith("https://"):
+            return _PROBE_VIDEO_RESULT
+        if isinstance(probe_error, Exception):
+            raise probe_error
+        return probe_error
 
-        # Check S3 client creation (R2, B2, and ASSETS)
-        assert mock_s3_client.call_count >= 3
+    mock_subprocess["ffprobe"] = probe
 
-        # Check steps
-        # 1. Download
-        mock_download_file.assert_called_once()
+    with patch.dict(handler_module.FEATURES, {"stream_input": True}):
+        result = handler_module.handler({"input": basic_job_input})
 
-        # 2. Transcode Mezzanine (uploaded to B2)
-        # 3. Transcode HLS (uploaded to R2)
-        # 4. Upload HLS directory
-        mock_upload_directory_tracked.assert_called()
+    assert result["status"] == "success"
+    mock_download_file.assert_called_once()
 
-        # 5. Webhook sent — progress webhooks fire during the run, so the final
-        # POST is the completion webhook.
-        assert mock_requests.called
-        call_args = mock_requests.call_args
-        assert call_args[0][0] == basic_job_input["webhookUrl"]
 
-        # Verify signature header
-        headers = call_args[1]["headers"]
-        assert "X-Runpod-Signature" in headers
+def test_handler_failure_redacts_presigned_input(
+    mock_s3_client,
+    mock_download_file,
+    mock_subprocess,
+    mock_requests,
+    mock_check_gpu,
+    mock_storage_env,
+    basic_job_input,
+    monkeypatch,
+):
+    """A failing streamed encode never reports the presigned URL's credentials."""
+    presigned = "https://r2.example.com/media-bucket/video.mp4?X-Amz-Signature=abc"
+    mock_s3_client.return_value.generate_presigned_url.return_value = presigned
+    mock_subprocess["ffprobe"] = _returns(_PROBE_VIDEO_RESULT)
+    monkeypatch.setattr(
+        handler_module,
+        "transcode_video_hls",
+        MagicMock(
+            side_effect=subprocess.TimeoutExpired(["ffmpeg", "-i", presigned], 1)
+        ),
+    )
+
+    with patch.dict(handler_module.FEATURES, {"stream_input": True}):
+        result = handler_module.handler({"input": basic_job_input})
+
+    assert result["status"] == "error"
+    assert "video.mp4?<redacted>" in result["error"]
+    webhook_error = json.loads(mock_requests.call_args[1]["data"])["error"]
+    assert "X-Amz-Signature" not in webhook_error
 
 
 def test_handler_audio_flow(
@@ -312,20 +986,7 @@ def test_handler_audio_flow(
     basic_job_input["inputKey"] = "user-123/originals/test-media-123/audio.mp3"
 
     # Mock probe response (audio only)
-    probe_data = json.dumps(
-        {"format": {"duration": "300.0"}, "streams": [{"codec_type": "audio"}]}
-    )
-
-    def subprocess_side_effect(cmd, **kwargs):
-        mock_res = MagicMock()
-        mock_res.returncode = 0
-        mock_res.stdout = ""
-        mock_res.stderr = ""
-        if "ffprobe" in cmd:
-            mock_res.stdout = probe_data
-        return mock_res
-
-    mock_subprocess.side_effect = subprocess_side_effect
+    mock_subprocess["ffprobe"] = _returns(_PROBE_AUDIO_RESULT)
 
     result = handler_module.handler({"input": basic_job_input})
 
@@ -336,13 +997,7 @@ def test_handler_audio_flow(
     # We can verify by checking what was uploaded
 
     # Verify waveform generation (audio only)
-    # Check if audiowaveform command was called
-    waveform_called = False
-    for call in mock_subprocess.call_args_list:
-        if "audiowaveform" in call[0][0]:
-            waveform_called = True
-            break
-    assert waveform_called
+    assert mock_subprocess.runs["audiowaveform"] > 0
 
 
 def test_handler_failure_reporting(
@@ -350,6 +1005,7 @@ def test_handler_failure_reporting(
     mock_download_file,
     mock_subprocess,
     mock_requests,
+    mock_check_gpu,
     mock_storage_env,
     basic_job_input,
 ):
@@ -371,36 +1027,57 @@ def test_handler_failure_reporting(
     assert payload["error"] == "S3 Download Error"
 
 
-def test_handler_timeout_protection(
+def test_handler_cleans_up_background_hls_upload(
     mock_s3_client,
     mock_download_file,
     mock_subprocess,
     mock_requests,
+    mock_check_gpu,
     mock_storage_env,
     basic_job_input,
 ):
-    """Test that handler catches subprocess timeouts and reports failure."""
-    import subprocess
-
-    # Mock probe success first. Must include a video stream so the handler's
-    # stream validation passes and we reach the (timing-out) transcode step.
-    probe_data = json.dumps(
-        {
-            "format": {"duration": "100.0"},
-            "streams": [{"codec_type": "video", "width": 1920, "height": 1080}],
-        }
+    """A failure after the HLS upload starts still deletes the uploaded keys."""
+    mock_subprocess["ffprobe"] = _returns(_PROBE_720P_RESULT)
+    hls_key = (
+        mock_s3_client,
+        "media-bucket",
+        "user-123/hls/test-media-123/master.m3u8",
     )
 
-    def side_effect(cmd, **kwargs):
-        if "ffprobe" in cmd:
-            m = MagicMock()
-            m.returncode = 0
-            m.stdout = probe_data
-            return m
-        # Simulate hang on transcoding
-        raise subprocess.TimeoutExpired(cmd, 3600)
+    with (
+        patch("handler.main.upload_directory_tracked", return_value=[hls_key]),
+        patch(
+            "handler.main.extract_thumbnail_variants",
+            side_effect=RuntimeError("thumbnail failed"),
+        ),
+        patch("handler.main.cleanup_uploaded_keys") as mock_cleanup,
+    ):
+        result = handler_module.handler({"input": basic_job_input})
+
+    assert result["status"] == "error"
+    assert hls_key in mock_cleanup.call_args[0][0]
+
+
+def test_handler_timeout_protection(
+    mock_s3_client,
+    mock_download_file,
+    mock_subprocess,
+    mock_requests,
+    mock_check_gpu,
+    mock_storage_env,
+    basic_job_input,
+    monkeypatch,
+):
+    """Test that handler catches subprocess timeouts and reports failure."""
 
-    mock_subprocess.side_effect = side_effect
+    # Probe must include a video stream so the handler's stream validation
+    # passes; the first transcode step then times out without running ffmpeg.
+    mock_subprocess["ffprobe"] = _returns(_PROBE_VIDEO_RESULT)
+    monkeypatch.setattr(
+        handler_module,
+        "transcode_video_hls",
+        MagicMock(side_effect=subprocess.TimeoutExpired(["ffmpeg"], 3600)),
+    )
 
     result = handler_module.handler({"input": basic_job_input})
 